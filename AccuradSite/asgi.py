@@ -0,0 +1,23 @@
+"""
+ASGI config for AccuradSite project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Async views need Django >= 3.1, serve with e.g.
+
+    uvicorn AccuradSite.asgi:application --host 0.0.0.0 --port 9013
+
+`async def run(request, param)` scripts are awaited on the event loop, plain
+`def run` scripts go to a thread pool of settings.ASYNC_THREADS threads.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'AccuradSite.settings')
+os.environ.setdefault('ACCURAD_ASGI', '1')
+
+application = get_asgi_application()
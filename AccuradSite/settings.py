@@ -11,7 +11,10 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import sys
+import tempfile
 import threading
+import zlib
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -49,6 +52,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'app.middleware.DBSessionMiddleware',
 ]
 
 ROOT_URLCONF = 'AccuradSite.urls'
@@ -72,6 +76,14 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'AccuradSite.wsgi.application'
 
+ASGI_APPLICATION = 'AccuradSite.asgi.application'
+
+# set by asgi.py, routes requests to the async dispatcher views.ainterface
+ASGI = os.environ.get('ACCURAD_ASGI') == '1'
+
+# size of the thread pool running sync `run` scripts under ASGI
+ASYNC_THREADS = 32
+
 
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
@@ -124,10 +136,26 @@ USE_L10N = True
 
 USE_TZ = True
 
-CTXS = {}
-
+# no longer needed around db calls, tools.db is thread safe (use db.session()),
+# kept for scripts written against older versions
 LOCK = threading.RLock()
 
+# conf.ini section behind request.db, see app/middleware.py
+REQUEST_DB_SECTION = 'DB'
+
+# seconds between scans of api/ for edited scripts, 0 disables hot reload:
+# on under runserver (development), off otherwise unless ACCURAD_API_RELOAD sets it
+API_RELOAD_INTERVAL = float(os.environ.get('ACCURAD_API_RELOAD', 2 if 'runserver' in sys.argv else 0))
+
+# body bytes the response cache of each worker may hold, see app/cache.py
+RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+
+# 'local': one cache per worker process, 'shared': one memory mapped file for
+# every worker of the host (app/shmcache.py), sized by RESPONSE_CACHE_BYTES
+RESPONSE_CACHE_BACKEND = 'local'
+RESPONSE_CACHE_PATH = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                                   'accurad-response-cache-%08x' % zlib.crc32(BASE_DIR.encode('utf-8')))
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 
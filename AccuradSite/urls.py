@@ -15,6 +15,7 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, re_path
+from AccuradSite import settings
 from app import views
 
 urlpatterns = [
@@ -26,5 +27,5 @@ urlpatterns = [
     # re_path('productlist.html', views.productlist, name='productlist'),
     # re_path('gbook.html', views.gbook, name='gbook'),
     # re_path('contact.html', views.contact, name='contact'),
-    re_path('.*', views.interface, name='interface'),
+    re_path('.*', views.ainterface if settings.ASGI else views.interface, name='interface'),
 ]
@@ -3,14 +3,39 @@ WSGI config for AccuradSite project.
 
 It exposes the WSGI callable as a module-level variable named ``application``.
 
+ACCURAD_GEVENT=1 serves in cooperative mode: the stdlib is gevent patched
+before django or any db driver is imported, see tools/green.py for the
+drivers that cooperate.
+
+Under uwsgi the app may be loaded once in the master and forked into the
+workers (lazy-apps=false), postfork hooks then drop the db connections and
+threads each worker inherited.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/2.1/howto/deployment/wsgi/
 """
 
 import os
 
+if os.environ.get('ACCURAD_GEVENT') == '1':
+    # before anything imports socket/threading, don't import tools here
+    from gevent import monkey
+    monkey.patch_all()
+
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'AccuradSite.settings')
 
 application = get_wsgi_application()
+
+try:
+    import uwsgidecorators
+except ImportError:
+    uwsgidecorators = None
+
+if uwsgidecorators is not None:
+    # uwsgi forks from C, os.register_at_fork hooks only run with py-call-osafterfork
+    from app import registry
+    from tools import db
+    uwsgidecorators.postfork(registry._after_fork)
+    uwsgidecorators.postfork(db.after_fork)
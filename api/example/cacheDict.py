@@ -0,0 +1,24 @@
+#!/bin/python3
+
+########################################################################################################################
+# 功能：缓存字典类查询的响应
+# 说明：CACHE声明后, 相同hospitalCode/departmentId的GET请求在ttl秒内直接返回缓存的响应, 不再查库
+#       同一时刻多个相同请求只执行一次run; 过期后stale秒内先返回旧响应, 由一个请求刷新
+#       只缓存code为0的响应, 命中率等见 server-manage/metrics 中的 response_cache
+#
+########################################################################################################################
+
+import tools
+
+CACHE = {'ttl': 300, 'key': ('hospitalCode', 'departmentId'), 'stale': 60}
+
+
+def run(request, param):
+    if param is None or "hospitalCode" not in param:
+        return tools.response(-1, "hospitalCode is empty!")
+    where = {"hospitalCode": param["hospitalCode"]}
+    if param.get("departmentId"):
+        where["departmentId"] = param["departmentId"]
+
+    rows = request.db.select("department", where=where)
+    return tools.response(0, '', rows)
@@ -7,7 +7,6 @@
 ########################################################################################################################
 
 import tools
-from AccuradSite import settings
 
 
 def run(request, param):
@@ -17,24 +16,22 @@ def run(request, param):
 
     db = tools.database(**dbinfo)
     db.printing = True
-    # 执行方式
-    settings.LOCK.acquire()
+    # 执行方式: session内的语句共用同一个连接, 各线程从连接池各取各的连接, 无需加锁
     try:
-        # ############################ 存储过程 ############################ #
-        parmout = [tools.CURSOR]
-        results = db.callproc("select_test1", [], parmout)
-        print("parmout0: ", parmout)
+        with db.session():
+            # ############################ 存储过程 ############################ #
+            parmout = [tools.CURSOR]
+            results = db.callproc("select_test1", [], parmout)
+            print("parmout0: ", parmout)
 
-        # 返回固定个数值, 返回结果集, 在tools.CURSOR字段中, 可通过parmout[i]获取
-        parmout = [tools.INT, tools.CURSOR, tools.FLOAT]
-        results = db.callproc("select_test", ["muti1"], parmout)
-        print("parmout: ", parmout)
+            # 返回固定个数值, 返回结果集, 在tools.CURSOR字段中, 可通过parmout[i]获取
+            parmout = [tools.INT, tools.CURSOR, tools.FLOAT]
+            results = db.callproc("select_test", ["muti1"], parmout)
+            print("parmout: ", parmout)
 
     except Exception as e:
         print('执行sql failed! [%s]' % str(e))
-        settings.LOCK.release()
         raise
-    settings.LOCK.release()
     print("return: ", results)
 
     # storage结果打包成json
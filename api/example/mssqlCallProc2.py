@@ -7,7 +7,6 @@
 ########################################################################################################################
 
 import tools
-from AccuradSite import settings
 
 
 def run(request, param):
@@ -17,28 +16,26 @@ def run(request, param):
 
     db = tools.database(**dbinfo)
     db.printing = True
-    # 执行方式
-    settings.LOCK.acquire()
+    # 执行方式: session内的语句共用同一个连接, 各线程从连接池各取各的连接, 无需加锁
     try:
-        cursor = db._db_cursor()
-        # ############################ 存储过程 ############################ #
-        declare = "declare @p1 INT declare @p2 DECIMAL(10,2) declare @ret INT"
-        exec = "exec @ret = select_test2 'fad',@p1 output,@p2 output"
-        select = "select @p1,@p2,@ret"
-        cursor.execute(f"%s %s %s" % (declare, exec, select))
-        result = cursor.fetchall()  # 得到结果集
-        for i in result:
-            print(i)
-        while cursor.nextset():
-            result = cursor.fetchall()
+        with db.session():
+            cursor = db._db_cursor()
+            # ############################ 存储过程 ############################ #
+            declare = "declare @p1 INT declare @p2 DECIMAL(10,2) declare @ret INT"
+            exec = "exec @ret = select_test2 'fad',@p1 output,@p2 output"
+            select = "select @p1,@p2,@ret"
+            cursor.execute(f"%s %s %s" % (declare, exec, select))
+            result = cursor.fetchall()  # 得到结果集
             for i in result:
                 print(i)
+            while cursor.nextset():
+                result = cursor.fetchall()
+                for i in result:
+                    print(i)
 
     except Exception as e:
         print('执行sql failed! [%s]' % str(e))
-        settings.LOCK.release()
         raise
-    settings.LOCK.release()
 
     # storage结果打包成json
     jsonData = tools.storage2Json(None)
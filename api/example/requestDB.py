@@ -0,0 +1,24 @@
+#!/bin/python3
+
+########################################################################################################################
+# 功能：使用请求级数据库会话
+# 说明：request.db对应conf.ini中settings.REQUEST_DB_SECTION配置的数据库, 其他配置段用request.dbs.get("段名")
+#       整个请求只从连接池取一次连接, 所有语句在同一个事务中, 返回响应时提交, 抛出异常或返回5xx时回滚
+#
+########################################################################################################################
+
+import tools
+
+
+def run(request, param):
+    # 结构化查询select
+    entries1 = request.db.select("test", what="*", where="a='hehe'", order="d desc", limit=3)
+
+    # 与上面的查询在同一个事务中
+    request.db.insert("test", a="sigal", b="n", c=0, d=10.1)
+    request.db.update("test", where="a='fad'", b='mn', c=2)
+
+    # storage结果打包成json
+    jsonData = tools.storage2Json(entries1)
+
+    return tools.response(0, '', jsonData)
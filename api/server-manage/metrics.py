@@ -0,0 +1,13 @@
+#!/bin/python3
+
+########################################################################################################################
+# 功能：查看当前worker进程的运行指标(连接池等)
+# 说明：每个uwsgi进程各自统计, 结果中pid为处理本次请求的进程
+#
+########################################################################################################################
+
+import tools
+
+
+def run(request, param):
+    return tools.response(0, '', tools.metrics.snapshot())
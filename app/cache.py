@@ -0,0 +1,333 @@
+"""
+api response cache
+
+A script declares its policy with CACHE, e.g.
+
+    CACHE = {'ttl': 300, 'key': ('hospitalCode', 'departmentId'), 'stale': 60, 'max_size': 256 * 1024}
+
+`ttl` seconds a response is served from memory, `key` the parameters that
+tell responses apart (all of them when left out), `stale` seconds an expired
+response may still be served while one request revalidates it, `max_size`
+the largest body kept (bytes). `CACHE = 300` is a ttl alone.
+
+Only GET requests answered with tools.response code 0 and HTTP 200 are
+kept, under (script, key parameters, _format, negotiated media type), in an
+LRU of at most settings.RESPONSE_CACHE_BYTES body bytes per process, or
+with RESPONSE_CACHE_BACKEND = 'shared' in one memory mapped file all the
+workers of the host read (see app/shmcache.py).
+Requests missing the same key wait for the one already running the script
+and share its response instead of all running it (SingleFlight); once
+expired, the first request runs the script again while the others get the
+stale response. Counters are in server-manage/metrics (response_cache).
+
+A script that can't be cached can still declare COALESCE = True: identical
+GET requests (same parameters, _format and media type) arriving while one
+runs wait for it and share its response, whatever its code, nothing is kept
+once it is sent.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+
+from django.http import HttpResponse
+
+from AccuradSite import settings
+import tools
+
+# seconds a request waits for the one running the same key before running it itself
+WAIT = 30
+
+
+class Policy(object):
+    """The CACHE declaration of a script."""
+    __slots__ = ["ttl", "key", "stale", "max_size"]
+
+    def __init__(self, ttl, key=None, stale=0, max_size=1 << 20):
+        self.ttl = float(ttl)
+        self.key = tuple(key) if key is not None else None
+        self.stale = float(stale)
+        self.max_size = int(max_size)
+
+    @classmethod
+    def of(cls, module):
+        """the policy declared by `module`, None when it has none or it is invalid"""
+        declared = getattr(module, 'CACHE', None)
+        if not declared:
+            return None
+        try:
+            if isinstance(declared, dict):
+                return cls(**declared)
+            return cls(declared)
+        except (TypeError, ValueError) as e:
+            print('response cache: invalid CACHE in [%s] ignored! [%s]' % (module.__name__, str(e)))
+            return None
+
+    def key_of(self, endpoint, request, parms):
+        return request_key(endpoint, request, parms, self.key)
+
+
+def request_key(endpoint, request, parms, names=None):
+    """what tells the responses of `endpoint` apart: the `names` parameters
+    (all of them by default), the result set layout and the media type"""
+    parms = parms or {}
+    if names is None:
+        values = tuple(sorted(parms.items()))
+    else:
+        values = tuple(parms.get(name) for name in names)
+    # a reloaded script starts from an empty cache
+    return (endpoint.name, endpoint.mtime, values,
+            tools.response_format(request), tools.accepted_type(request))
+
+
+class Entry(object):
+    """An encoded response, what the cache keeps and waiting requests share."""
+    __slots__ = ["status", "content_type", "vary", "body", "code", "expires", "stale_until", "size"]
+
+    def __init__(self, status, content_type, vary, body, code, expires=0, stale_until=0):
+        self.status = status
+        self.content_type = content_type
+        self.vary = vary
+        self.body = body
+        self.code = code
+        self.expires = expires
+        self.stale_until = stale_until
+        # the body and the bookkeeping around it
+        self.size = len(body) + 200
+
+    @classmethod
+    def of(cls, response):
+        """None for responses that can't be replayed (streamed, file...)"""
+        if getattr(response, 'streaming', False):
+            return None
+        return cls(response.status_code, response.get('Content-Type'), response.get('Vary'),
+                   response.content, getattr(response, 'code', None))
+
+    def response(self):
+        response = HttpResponse(self.body, content_type=self.content_type, status=self.status)
+        if self.vary:
+            response['Vary'] = self.vary
+        response.code = self.code
+        return response
+
+
+class ResponseCache(object):
+    """LRU of Entries holding at most `max_bytes`, thread safe."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = self.misses = self.stale = self.evictions = self.expired = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        """the entry of `key`, expired ones included until their stale window ends"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and now >= entry.stale_until:
+                del self._data[key]
+                self.bytes -= entry.size
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            if now < entry.expires:
+                self.hits += 1
+            else:
+                self.stale += 1
+            return entry
+
+    def put(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old.size
+            self._data[key] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes:
+                _, old = self._data.popitem(last=False)
+                self.bytes -= old.size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.stale + self.misses
+        return {"backend": "local", "entries": len(self._data), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "stale_hits": self.stale, "misses": self.misses,
+                "evictions": self.evictions, "expired": self.expired,
+                "hit_ratio": round((self.hits + self.stale) / lookups, 3) if lookups else None}
+
+
+class SingleFlight(object):
+    """
+    At most one call per key at a time: the first caller of `begin` leads and
+    publishes its result with `end`, the others wait on the same future.
+
+        >>> flights = SingleFlight()
+        >>> flights.do('k', lambda: 42)
+        42
+    """
+    def __init__(self):
+        self.leaders = self.followers = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        """returns (future, True) for the leader, (future of the leader, False) for the others"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.followers += 1
+                return future, False
+            future = self._calls[key] = concurrent.futures.Future()
+            self.leaders += 1
+            return future, True
+
+    def end(self, key, future, result=None, error=None):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, func, *args):
+        future, leader = self.begin(key)
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args)
+        except BaseException as e:
+            self.end(key, future, error=e)
+            raise
+        self.end(key, future, result)
+        return result
+
+    def stats(self):
+        return {"in_flight": len(self._calls), "leaders": self.leaders, "followers": self.followers}
+
+
+def _open_cache():
+    max_bytes = getattr(settings, 'RESPONSE_CACHE_BYTES', 64 << 20)
+    if getattr(settings, 'RESPONSE_CACHE_BACKEND', 'local') == 'shared':
+        try:
+            from .shmcache import SharedResponseCache
+            return SharedResponseCache(settings.RESPONSE_CACHE_PATH, max_bytes)
+        except (ImportError, OSError) as e:
+            # no fcntl (windows) or no writable path
+            print('response cache: shared memory unavailable, each worker keeps its own! [%s]' % str(e))
+    return ResponseCache(max_bytes)
+
+
+_cache = _open_cache()
+_flights = SingleFlight()
+
+
+def _lookup(endpoint, request, parms):
+    """
+    Returns (response, key, future, leader): `response` when the request is
+    answered from the cache, else the leader runs the script and `_store`s
+    its response while the others wait on `future`. `key` is None when the
+    request isn't cached nor coalesced.
+    """
+    policy = endpoint.cache
+    if request.method != 'GET':
+        return None, None, None, False
+    if policy is None:
+        if not endpoint.coalesce:
+            return None, None, None, False
+        key = request_key(endpoint, request, parms)
+        future, leader = _flights.begin(key)
+        return None, key, future, leader
+    key = policy.key_of(endpoint, request, parms)
+    now = time.time()
+    entry = _cache.get(key, now)
+    if entry is not None and now < entry.expires:
+        return entry.response(), key, None, False
+    future, leader = _flights.begin(key)
+    if entry is not None and not leader:
+        # stale while revalidate: someone is already refreshing it
+        return entry.response(), key, None, False
+    return None, key, future, leader
+
+
+def _store(endpoint, key, future, response):
+    policy = endpoint.cache
+    entry = Entry.of(response)
+    if policy is not None and entry is not None and entry.status == 200 and entry.code == 0 and len(entry.body) <= policy.max_size:
+        now = time.time()
+        entry.expires = now + policy.ttl
+        entry.stale_until = entry.expires + policy.stale
+        _cache.put(key, entry)
+    _flights.end(key, future, entry)
+
+
+def _shared(entry):
+    # None: the leader's response couldn't be shared, run the script ourselves
+    return entry.response() if entry is not None else None
+
+
+def serve(endpoint, request, parms, run):
+    """`run()` answered through the cache policy of `endpoint`, or coalesced with identical requests."""
+    response, key, future, leader = _lookup(endpoint, request, parms)
+    if response is not None:
+        return response
+    if key is None:
+        return run()
+    if not leader:
+        try:
+            response = _shared(future.result(WAIT))
+        except concurrent.futures.TimeoutError:
+            response = None
+        return response if response is not None else run()
+    try:
+        response = run()
+    except BaseException as e:
+        _flights.end(key, future, error=e)
+        raise
+    _store(endpoint, key, future, response)
+    return response
+
+
+async def aserve(endpoint, request, parms, run):
+    """`serve` for `async def run` scripts, `run()` returns an awaitable."""
+    response, key, future, leader = _lookup(endpoint, request, parms)
+    if response is not None:
+        return response
+    if key is None:
+        return await run()
+    if not leader:
+        try:
+            # shielded: a timeout here must not cancel the leader's future
+            response = _shared(await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), WAIT))
+        except asyncio.TimeoutError:
+            response = None
+        return response if response is not None else await run()
+    try:
+        response = await run()
+    except BaseException as e:
+        _flights.end(key, future, error=e)
+        raise
+    _store(endpoint, key, future, response)
+    return response
+
+
+def stats():
+    out = _cache.stats()
+    out["flights"] = _flights.stats()
+    return out
+
+
+tools.metrics.register('response_cache', stats)
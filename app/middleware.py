@@ -0,0 +1,108 @@
+"""
+Request scoped database session.
+
+`request.db` is the database of the settings.REQUEST_DB_SECTION section of
+conf.ini, `request.dbs.get(section)` the one of any other section. Each is
+opened on first use, checked out of the pool once and runs in one transaction
+for the whole request: committed when the response is sent, rolled back when
+the view raises or answers with a 5xx status.
+
+The middleware runs in both stacks: under ASGI it is awaited on the event
+loop, the commit or rollback going to the pool of tools.run_sync, instead of
+django running it (and the whole view behind it) in its one sync thread.
+"""
+import asyncio
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import SimpleLazyObject
+
+import tools
+
+
+class RequestSession(object):
+    """Databases opened by one request, each inside its own transaction."""
+    def __init__(self):
+        self._open = {}
+
+    def get(self, section=None):
+        section = section or getattr(settings, 'REQUEST_DB_SECTION', 'DB')
+        if section in self._open:
+            return self._open[section][0]
+        state, dbinfo = tools.getDBConf(section)
+        if not state:
+            raise ImproperlyConfigured(dbinfo)
+        db = tools.database(dbinfo).bind()
+        self._open[section] = (db, db.transaction())
+        return db
+
+    def commit(self):
+        """Commits every open database, what is left after a failed commit is rolled back."""
+        while self._open:
+            section, (db, transaction) = self._open.popitem()
+            try:
+                transaction.commit()
+            except:
+                self._open[section] = (db, transaction)
+                self.rollback()
+                raise
+
+    def rollback(self):
+        """Rolls back every open database, a later `get` starts a new transaction."""
+        while self._open:
+            section, (db, transaction) = self._open.popitem()
+            try:
+                transaction.rollback()
+            except Exception as e:
+                print('rollback [%s] failed! [%s]' % (section, str(e)))
+                db.closedb()
+
+
+class DBSessionMiddleware(object):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # tells django to await __call__, as django.utils.deprecation.MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        session = self._begin(request)
+        try:
+            response = self.get_response(request)
+        except:
+            session.rollback()
+            raise
+        self._end(session, response)
+        return response
+
+    async def __acall__(self, request):
+        session = self._begin(request)
+        try:
+            response = await self.get_response(request)
+        except:
+            if session._open:
+                await tools.run_sync(session.rollback)
+            raise
+        if session._open:
+            await tools.run_sync(self._end, session, response)
+        return response
+
+    def _begin(self, request):
+        session = request.dbs = RequestSession()
+        request.db = SimpleLazyObject(session.get)
+        return session
+
+    def _end(self, session, response):
+        if response.status_code >= 500:
+            session.rollback()
+        else:
+            session.commit()
+
+    def process_exception(self, request, exception):
+        request.dbs.rollback()
@@ -0,0 +1,236 @@
+"""
+api endpoint registry
+
+Walks the `api/` tree once at startup, imports every script and keeps the
+ones exposing `run` in memory, so `views.interface` resolves a request
+path with a dict lookup instead of stat + import on every request.
+
+Scripts edited on disk are picked up by a polling watcher thread: the
+changed file is compiled in the background and its Endpoint swapped into
+the registry, requests already running keep the `run` they started with.
+"""
+import asyncio
+import importlib
+import importlib.util
+import os
+import sys
+import threading
+import traceback
+
+from AccuradSite import settings
+from . import cache
+
+API_DIR = os.path.join(settings.BASE_DIR, "api")
+
+_endpoints = {}
+_lock = threading.RLock()
+
+
+class Endpoint(object):
+    """A loaded api script.
+
+    `run` is None when the script has no entry, `error` holds the import
+    error when the script failed to load. `coroutine` tells whether `run`
+    is an `async def`, `unit_of_work` whether the script asks for its
+    commits to be deferred to the end of `run` (UNIT_OF_WORK = True),
+    `response_format` how tools.response lays out its result sets when the
+    request doesn't say (RESPONSE_FORMAT = 'columnar'), `cache` the
+    cache.Policy of its responses (CACHE = {'ttl': 300, ...}), `coalesce`
+    whether identical requests share one run (COALESCE = True).
+    """
+    __slots__ = ["name", "module", "run", "error", "path", "mtime", "coroutine", "unit_of_work",
+                 "response_format", "cache", "coalesce"]
+
+    def __init__(self, name, module=None, run=None, error=None, path=None, mtime=None):
+        self.name = name
+        self.module = module
+        self.run = run
+        self.error = error
+        self.path = path
+        self.mtime = mtime
+        self.coroutine = asyncio.iscoroutinefunction(run)
+        self.unit_of_work = bool(getattr(module, 'UNIT_OF_WORK', False))
+        self.response_format = getattr(module, 'RESPONSE_FORMAT', None)
+        self.cache = cache.Policy.of(module)
+        self.coalesce = bool(getattr(module, 'COALESCE', False))
+
+    def __repr__(self):
+        return '<Endpoint %s>' % self.name
+
+
+def scan(root=API_DIR):
+    """Returns {name: path} for every script under `root`, `name` being the
+    url form of the script path, e.g. 'example/parseParam'.
+    """
+    scripts = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != "__pycache__"]
+        for filename in filenames:
+            base, ext = os.path.splitext(filename)
+            if ext not in (".py", ".pyc"):
+                continue
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(os.path.join(dirpath, base), root).replace(os.sep, "/")
+            # prefer the source file when both .py and .pyc exist
+            if ext == ".pyc" and name in scripts:
+                continue
+            scripts[name] = path
+    return scripts
+
+
+def modname(name):
+    return "api." + name.replace("/", ".")
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def load_endpoint(name, path):
+    mtime = _mtime(path)
+    try:
+        module = importlib.import_module(modname(name))
+    except Exception as e:
+        traceback.print_exc()
+        return Endpoint(name, error="%s: %s" % (e.__class__.__name__, e), path=path, mtime=mtime)
+    return Endpoint(name, module, getattr(module, 'run', None), path=path, mtime=mtime)
+
+
+def compile_endpoint(name, path):
+    """Compiles `path` into a fresh module object without touching the one
+    currently serving requests. Raises on syntax/import errors.
+    """
+    mtime = _mtime(path)
+    spec = importlib.util.spec_from_file_location(modname(name), path)
+    module = importlib.util.module_from_spec(spec)
+    if path.endswith(".py"):
+        # compile from source, __pycache__ only has a 1s mtime resolution
+        code = compile(spec.loader.get_data(path), path, "exec")
+        exec(code, module.__dict__)
+    else:
+        spec.loader.exec_module(module)
+    return Endpoint(name, module, getattr(module, 'run', None), path=path, mtime=mtime)
+
+
+def load(root=API_DIR):
+    """(Re)builds the registry from the scripts under `root`."""
+    global _endpoints
+    with _lock:
+        endpoints = {}
+        for name, path in scan(root).items():
+            endpoints[name] = load_endpoint(name, path)
+        _endpoints = endpoints
+    print("api registry: %d scripts loaded(%s)" % (len(endpoints), os.getpid()))
+    return endpoints
+
+
+def refresh(root=API_DIR):
+    """Reloads scripts added, changed or removed since the last scan.
+
+    A script that fails to compile keeps serving its previous version.
+    Returns the names that were swapped.
+    """
+    global _endpoints
+    with _lock:
+        current = _endpoints
+        scripts = scan(root)
+        changed = {}
+        for name, path in scripts.items():
+            old = current.get(name)
+            if old is not None and old.path == path and old.mtime == _mtime(path):
+                continue
+            try:
+                endpoint = compile_endpoint(name, path)
+            except Exception as e:
+                traceback.print_exc()
+                if old is not None and old.error is None:
+                    # keep the working version, retry once the file changes again
+                    old.mtime = _mtime(path)
+                    continue
+                endpoint = Endpoint(name, error="%s: %s" % (e.__class__.__name__, e), path=path, mtime=_mtime(path))
+            else:
+                sys.modules[modname(name)] = endpoint.module
+            changed[name] = endpoint
+        removed = [name for name in current if name not in scripts]
+        if not changed and not removed:
+            return []
+
+        # copy-on-write: readers always see either the old or the new dict
+        endpoints = dict(current)
+        endpoints.update(changed)
+        for name in removed:
+            endpoints.pop(name, None)
+            sys.modules.pop(modname(name), None)
+        _endpoints = endpoints
+    for name in sorted(changed):
+        print("api registry: reloaded [%s](%s)" % (name, os.getpid()))
+    for name in removed:
+        print("api registry: removed [%s](%s)" % (name, os.getpid()))
+    return sorted(changed) + removed
+
+
+class Watcher(threading.Thread):
+    """Polls the api/ tree every `interval` seconds and refreshes the registry."""
+    def __init__(self, interval, root=API_DIR):
+        threading.Thread.__init__(self, name="api-watcher")
+        self.daemon = True
+        self.interval = interval
+        self.root = root
+        self.pid = os.getpid()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                refresh(self.root)
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self):
+        self.stopped.set()
+
+
+_watcher = None
+
+
+def watch(interval=None):
+    """Starts the watcher thread of this process, `interval` defaults to
+    settings.API_RELOAD_INTERVAL, 0 disables reloading.
+    """
+    global _watcher
+    if interval is None:
+        interval = getattr(settings, 'API_RELOAD_INTERVAL', 0)
+    if not interval:
+        return None
+    with _lock:
+        if _watcher is None or _watcher.pid != os.getpid() or not _watcher.is_alive():
+            _watcher = Watcher(interval)
+            _watcher.start()
+    return _watcher
+
+
+def _after_fork():
+    # threads don't survive fork, give each pre-forked worker its own watcher;
+    # may run twice under uwsgi (os.register_at_fork and postfork)
+    global _watcher, _lock
+    if _watcher is None or _watcher.pid == os.getpid():
+        return
+    _lock = threading.RLock()
+    _watcher = None
+    watch()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def get(name):
+    """Returns the Endpoint registered for `name` or None."""
+    return _endpoints.get(name)
+
+
+def endpoints():
+    return dict(_endpoints)
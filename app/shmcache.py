@@ -0,0 +1,242 @@
+"""
+shared memory backend of the response cache
+
+One file mapped by every worker of the host (settings.RESPONSE_CACHE_BACKEND
+= 'shared'), so an encoded response is cached once instead of once per
+uwsgi process:
+
+    header | slot table | arena
+
+A key hashes to one slot (hash, position, length, expires, stale_until);
+the record it points to (key, meta, body) lives in the arena, a ring the
+writers fill in turn: the oldest records are overwritten first, a slot
+whose record was overwritten reads as a miss. Slots are guarded by lock
+stripes, each a thread lock plus an fcntl lock on one byte of the file
+(those only exclude other processes), the ring head by one more.
+
+A reader copies the record under its slot lock, then checks the head
+did not lap over it meanwhile: writers move the head before they write.
+
+The layout (slots x arena bytes) is part of the file name, so workers
+sized differently, e.g. old ones during a reload, each map their own file.
+A file that still doesn't match (another version) is replaced by a new
+one, never resized in place: processes mapping it would get SIGBUS.
+"""
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+
+from .cache import Entry
+
+MAGIC = b'ACRC0001'
+_header = struct.Struct('<8sIIQQ')   # magic, slots, stripes, arena size, head
+_slot = struct.Struct('<QQIxxxxdd')  # key hash, position, length, expires, stale_until
+_record = struct.Struct('<III')      # key, meta, body lengths
+HEADER_SIZE = 4096
+STRIPES = 64
+_HEAD_LOCK = STRIPES  # the byte locked around the ring head, stripes lock bytes 0..STRIPES-1
+
+
+def _key_bytes(key):
+    # repr of str / float / tuple keys is the same in every process, hash() is not
+    return repr(key).encode('utf-8')
+
+
+def _hash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little') or 1
+
+
+class SharedResponseCache(object):
+    """The ResponseCache interface over a memory mapped file at `path`."""
+    def __init__(self, path, max_bytes, slots=None):
+        self.max_bytes = max_bytes
+        self.slots = slots or max(1024, max_bytes // 16384)
+        self.arena = max_bytes
+        self.path = '%s.%dx%d' % (path, self.slots, self.arena)
+        self.hits = self.misses = self.stale = self.evictions = self.expired = 0
+        self._table = HEADER_SIZE
+        self._start = HEADER_SIZE + self.slots * _slot.size
+        self._size = self._start + self.arena
+        self._new_locks()
+        self._fd, self._mm = self._map()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._new_locks)
+
+    def _map(self):
+        """opens and maps the file at `path`, setting it up when it is new"""
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                # closing any descriptor of the file drops this lock: the header is read with pread
+                fcntl.lockf(fd, fcntl.LOCK_EX, 1, _HEAD_LOCK)
+                if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                    continue  # replaced while we waited for the lock
+                size = os.fstat(fd).st_size
+                if size == 0:
+                    # just created, nobody maps it before it holds a header
+                    os.ftruncate(fd, self._size)
+                    os.pwrite(fd, self._header(), 0)
+                elif size != self._size or not self._valid(fd):
+                    self._replace()
+                    continue
+                mm = mmap.mmap(fd, self._size)
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, _HEAD_LOCK)
+                fd, out = None, (fd, mm)
+                return out
+            finally:
+                if fd is not None:
+                    os.close(fd)
+
+    def _header(self):
+        return _header.pack(MAGIC, self.slots, STRIPES, self.arena, 0)
+
+    def _valid(self, fd):
+        data = os.pread(fd, _header.size, 0)
+        if len(data) != _header.size:
+            return False
+        magic, slots, stripes, arena, _ = _header.unpack(data)
+        return (magic, slots, stripes, arena) == (MAGIC, self.slots, STRIPES, self.arena)
+
+    def _replace(self):
+        """puts a new file in place of the one at `path`, whoever maps the old one keeps it"""
+        temp = '%s.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(temp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, self._size)
+            os.pwrite(fd, self._header(), 0)
+        finally:
+            os.close(fd)
+        os.replace(temp, self.path)
+
+    def _new_locks(self):
+        # a thread lock held at fork time would stay held in the child
+        self._locks = [threading.Lock() for _ in range(STRIPES + 1)]
+
+    def _locked(self, stripe):
+        return _StripeLock(self._fd, self._locks[stripe], stripe)
+
+    def _head(self):
+        return _header.unpack_from(self._mm, 0)[4]
+
+    def _reserve(self, length):
+        """the ring position of `length` free bytes, the head moves past them"""
+        with self._locked(_HEAD_LOCK):
+            head = self._head()
+            offset = head % self.arena
+            if offset + length > self.arena:
+                # records don't wrap, skip to the start of the next lap
+                head += self.arena - offset
+            struct.pack_into('<Q', self._mm, 24, head + length)
+        return head
+
+    def get(self, key, now):
+        data = _key_bytes(key)
+        h = _hash(data)
+        index = h % self.slots
+        where = self._table + index * _slot.size
+        with self._locked(index % STRIPES):
+            hashed, position, length, expires, stale_until = _slot.unpack_from(self._mm, where)
+            record = None
+            if hashed == h:
+                if now >= stale_until:
+                    _slot.pack_into(self._mm, where, 0, 0, 0, 0, 0)
+                    self.expired += 1
+                else:
+                    offset = self._start + position % self.arena
+                    record = self._mm[offset:offset + length]
+                    if position < self._head() - self.arena:
+                        # lapped by the ring
+                        _slot.pack_into(self._mm, where, 0, 0, 0, 0, 0)
+                        self.evictions += 1
+                        record = None
+        entry = record and self._load(record, data, expires, stale_until)
+        if entry is None:
+            self.misses += 1
+        elif now < expires:
+            self.hits += 1
+        else:
+            self.stale += 1
+        return entry
+
+    def _load(self, record, key, expires, stale_until):
+        key_length, meta_length, body_length = _record.unpack_from(record, 0)
+        start = _record.size
+        if record[start:start + key_length] != key:
+            return None  # another key with the same hash
+        start += key_length
+        status, content_type, vary, code = json.loads(record[start:start + meta_length].decode('utf-8'))
+        start += meta_length
+        return Entry(status, content_type, vary, record[start:start + body_length], code, expires, stale_until)
+
+    def put(self, key, entry):
+        data = _key_bytes(key)
+        meta = json.dumps([entry.status, entry.content_type, entry.vary, entry.code]).encode('utf-8')
+        length = _record.size + len(data) + len(meta) + len(entry.body)
+        if length > self.arena // 4:
+            return
+        position = self._reserve(length)
+        offset = self._start + position % self.arena
+        _record.pack_into(self._mm, offset, len(data), len(meta), len(entry.body))
+        offset += _record.size
+        for part in (data, meta, entry.body):
+            self._mm[offset:offset + len(part)] = part
+            offset += len(part)
+
+        h = _hash(data)
+        index = h % self.slots
+        where = self._table + index * _slot.size
+        with self._locked(index % STRIPES):
+            hashed, old, _, _, _ = _slot.unpack_from(self._mm, where)
+            if hashed and hashed != h and old >= self._head() - self.arena:
+                self.evictions += 1
+            _slot.pack_into(self._mm, where, h, position, length, entry.expires, entry.stale_until)
+
+    def clear(self):
+        for stripe in range(STRIPES):
+            with self._locked(stripe):
+                for index in range(stripe, self.slots, STRIPES):
+                    _slot.pack_into(self._mm, self._table + index * _slot.size, 0, 0, 0, 0, 0)
+
+    def stats(self):
+        """counters of this process, entries and bytes of the whole host"""
+        head = self._head()
+        entries = used = 0
+        for index in range(self.slots):
+            hashed, position, length, _, _ = _slot.unpack_from(self._mm, self._table + index * _slot.size)
+            if hashed and position >= head - self.arena:
+                entries += 1
+                used += length
+        lookups = self.hits + self.stale + self.misses
+        return {"backend": "shared", "path": self.path, "entries": entries, "bytes": used,
+                "max_bytes": self.max_bytes, "slots": self.slots,
+                "hits": self.hits, "stale_hits": self.stale, "misses": self.misses,
+                "evictions": self.evictions, "expired": self.expired,
+                "hit_ratio": round((self.hits + self.stale) / lookups, 3) if lookups else None}
+
+
+class _StripeLock(object):
+    """one stripe: the thread lock for this process, the fcntl lock for the others"""
+    __slots__ = ["fd", "lock", "byte"]
+
+    def __init__(self, fd, lock, byte):
+        self.fd = fd
+        self.lock = lock
+        self.byte = byte
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.byte)
+        except:
+            self.lock.release()
+            raise
+
+    def __exit__(self, *exc):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.byte)
+        finally:
+            self.lock.release()
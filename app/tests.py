@@ -1,3 +1,1253 @@
-from django.test import TestCase
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
+import time
 
-# Create your tests here.
+from django.test import SimpleTestCase
+from django.urls import re_path
+
+from . import views
+from .cache import Entry
+
+
+def _entry(body, ttl=60):
+    now = time.time()
+    return Entry(200, 'application/json', 'Accept', body, 0, now + ttl, now + ttl)
+
+
+def _shared_worker(path, max_bytes, name, start, done, out):
+    # one uwsgi worker: opens the file at the same time as the others, writes its key, reads everyone's
+    from .shmcache import SharedResponseCache
+    start.wait()
+    cache = SharedResponseCache(path, max_bytes, slots=64)
+    cache.put(('worker', name), _entry(name.encode() * 100))
+    done.wait()
+    bodies = {}
+    for other in range(4):
+        entry = cache.get(('worker', str(other)), time.time())
+        bodies[str(other)] = entry and entry.body
+    out.put((name, os.stat(cache.path).st_ino, bodies))
+
+
+def _shared_filler(path, max_bytes, count):
+    from .shmcache import SharedResponseCache
+    cache = SharedResponseCache(path, max_bytes, slots=1024)
+    for i in range(count):
+        cache.put(('fill', i), _entry(b'%05d' % i * 1000))
+
+
+def _forked_worker(db, parent, out):
+    # a pre-forked worker, the parent had `parent` checked out in this thread
+    from tools import db as dbmodule
+    fresh = not db._ctx.get('db')
+    db.query('SELECT 1')
+    stats = db.pool.stats()
+    out.put((fresh, stats.created, stats.size, db.pool.pid == os.getpid(),
+             any(held is parent for held in dbmodule._inherited)))
+
+
+def _scripts(test, **sources):
+    """serves the api scripts `sources` ({'test/name': source}) for the length of `test`"""
+    from . import registry
+    root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, root)
+    saved = registry._endpoints
+    test.addCleanup(setattr, registry, '_endpoints', saved)
+    endpoints = dict(saved)
+    for name, source in sources.items():
+        path = os.path.join(root, name.replace('/', '_') + '.py')
+        with open(path, 'w') as f:
+            f.write(textwrap.dedent(source))
+        endpoints[name] = registry.compile_endpoint(name, path)
+    registry._endpoints = endpoints
+    return endpoints
+
+
+def _sqlite_conf(test, *sections):
+    """a conf.ini whose `sections` are pooled sqlite databases in a temporary
+    directory, returns that directory"""
+    from tools import accutils
+    from tools.db import SqliteDB, register_database
+
+    class ConfSqliteDB(SqliteDB):
+        # takes the params of a conf.ini section, the server ones are of no use to sqlite
+        def __init__(self, **keywords):
+            for name in ('host', 'port', 'user', 'pw'):
+                keywords.pop(name, None)
+            SqliteDB.__init__(self, check_same_thread=False, **keywords)
+            self.has_pooling = True
+
+    register_database('testsqlite', ConfSqliteDB)
+    root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, root)
+    path = os.path.join(root, 'conf.ini')
+    with open(path, 'w') as f:
+        for section in sections:
+            f.write('[%s]\nHOST=localhost\nDBN=testsqlite\nDB=%s\nUSER=u\nPW=p\n\n'
+                    % (section, os.path.join(root, section + '.db')))
+    test.addCleanup(setattr, accutils, 'CONF_FILE', accutils.CONF_FILE)
+    test.addCleanup(setattr, accutils, '_conf', None)
+    accutils.CONF_FILE, accutils._conf = path, None
+    return root
+
+
+def _conf_db(section):
+    import tools
+    return tools.database(tools.getDBConf(section)[1])
+
+
+class SharedResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        from .shmcache import SharedResponseCache
+        self.Cache = SharedResponseCache
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache')
+        self.context = multiprocessing.get_context('fork')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_processes_share_one_file(self):
+        start, done, out = self.context.Event(), self.context.Barrier(4), self.context.Queue()
+        workers = [self.context.Process(target=_shared_worker,
+                                        args=(self.path, 1 << 20, str(i), start, done, out))
+                   for i in range(4)]
+        for worker in workers:
+            worker.start()
+        start.set()
+        results = [out.get(timeout=30) for _ in workers]
+        for worker in workers:
+            worker.join(30)
+            self.assertEqual(worker.exitcode, 0)
+        self.assertEqual(len(set(inode for _, inode, _ in results)), 1)
+        for _, _, bodies in results:
+            self.assertEqual(bodies, dict((str(i), str(i).encode() * 100) for i in range(4)))
+
+    def test_put_get(self):
+        cache = self.Cache(self.path, 1 << 20, slots=64)
+        key = ('example/x', 1.5, (('a', '1'),), 'rows', 'application/json')
+        cache.put(key, _entry(b'{"code": 0}'))
+        entry = cache.get(key, time.time())
+        self.assertEqual((entry.status, entry.content_type, entry.vary, entry.code, entry.body),
+                         (200, 'application/json', 'Accept', 0, b'{"code": 0}'))
+        self.assertIsNone(cache.get(('example/y',), time.time()))
+        cache.put(('old',), _entry(b'x', ttl=-1))
+        self.assertIsNone(cache.get(('old',), time.time()))
+
+    def test_lapped_records_read_as_misses(self):
+        cache = self.Cache(self.path, 65536, slots=1024)
+        cache.put(('first',), _entry(b'first'))
+        # another process writes far more than the arena holds
+        filler = self.context.Process(target=_shared_filler, args=(self.path, 65536, 100))
+        filler.start()
+        filler.join(30)
+        self.assertEqual(filler.exitcode, 0)
+        self.assertIsNone(cache.get(('first',), time.time()))
+        self.assertIsNone(cache.get(('fill', 0), time.time()))
+        self.assertEqual(cache.get(('fill', 99), time.time()).body, b'00099' * 1000)
+
+    def test_other_layout_is_replaced_not_truncated(self):
+        cache = self.Cache(self.path, 1 << 20, slots=64)
+        cache.put(('kept',), _entry(b'kept'))
+        # a file of the same name written by another version, still mapped by a live worker
+        with open(cache.path, 'r+b') as f:
+            f.write(b'OTHERVER')
+            old = mmap.mmap(f.fileno(), 0)
+        inode = os.stat(cache.path).st_ino
+        fresh = self.Cache(self.path, 1 << 20, slots=64)
+        self.assertNotEqual(os.stat(fresh.path).st_ino, inode)
+        self.assertIsNone(fresh.get(('kept',), time.time()))
+        # the old mapping is intact
+        self.assertEqual(old[:8], b'OTHERVER')
+        self.assertEqual(len(old[-4096:]), 4096)
+        old.close()
+
+    def test_sizes_get_their_own_file(self):
+        small = self.Cache(self.path, 1 << 20, slots=64)
+        large = self.Cache(self.path, 1 << 21, slots=64)
+        self.assertNotEqual(small.path, large.path)
+        small.put(('k',), _entry(b'small'))
+        self.assertIsNone(large.get(('k',), time.time()))
+        self.assertEqual(small.get(('k',), time.time()).body, b'small')
+
+
+class RowTests(SimpleTestCase):
+    def setUp(self):
+        import tools
+        self.tools = tools
+        self.row = tools.utils.rowtype(['id', 'name'])((1, 'a'))
+
+    def test_attribute_and_key_access(self):
+        row = self.row
+        self.assertEqual((row.id, row['name']), (1, 'a'))
+        row.name = 'b'
+        row['extra'] = 2
+        self.assertEqual((row['name'], row.extra), ('b', 2))
+        self.assertEqual(list(row), ['id', 'name', 'extra'])
+        self.assertEqual(row.items(), [('id', 1), ('name', 'b'), ('extra', 2)])
+
+    def test_missing_key(self):
+        with self.assertRaises(KeyError):
+            self.row['missing']
+        with self.assertRaises(AttributeError):
+            self.row.missing
+        self.assertIsNone(self.row.get('missing'))
+        self.assertEqual(self.row.get('missing', 0), 0)
+        self.assertNotIn('missing', self.row)
+
+    def test_dict_methods(self):
+        row = self.row
+        self.assertEqual(dict(row), {'id': 1, 'name': 'a'})
+        self.assertEqual(row._asdict(), {'id': 1, 'name': 'a'})
+        self.assertFalse(isinstance(row, dict))
+        copy = row.copy()
+        copy.update({'name': 'b'}, extra=3)
+        self.assertEqual(copy.setdefault('extra', 4), 3)
+        self.assertEqual(copy.setdefault('other', 5), 5)
+        self.assertEqual(copy.pop('id'), 1)
+        self.assertEqual(copy.pop('id', None), None)
+        self.assertEqual(dict(copy), {'name': 'b', 'extra': 3, 'other': 5})
+        self.assertEqual(dict(row), {'id': 1, 'name': 'a'})
+
+    def test_json_output(self):
+        import decimal
+        import json
+        from tools import encoder
+        with self.assertRaises(TypeError):
+            json.dumps([self.row])
+        self.row.price = decimal.Decimal('1.5')
+        self.assertEqual(json.loads(json.dumps([self.row], default=self.tools.json_default)),
+                         [{'id': 1, 'name': 'a', 'price': 1.5}])
+        self.assertEqual(json.loads(encoder.encode([self.row])), [{'id': 1, 'name': 'a', 'price': 1.5}])
+
+
+def _sqlite_pool(**options):
+    import sqlite3
+    from tools.db import ConnectionPool
+    return ConnectionPool(lambda: sqlite3.connect(':memory:', check_same_thread=False), **options)
+
+
+def _pooled_sqlite(test):
+    """a sqlite DB on a pool, as the server databases are, in a file removed after `test`"""
+    from tools.db import SqliteDB
+
+    class PooledSqliteDB(SqliteDB):
+        def __init__(self, **keywords):
+            SqliteDB.__init__(self, **keywords)
+            self.has_pooling = True
+
+    path = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, path)
+    return PooledSqliteDB(db=os.path.join(path, 'pool.db'), check_same_thread=False)
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def test_acquire_release(self):
+        pool = _sqlite_pool(maxsize=2)
+        entry = pool.get()
+        self.assertEqual(entry.conn.execute('SELECT 1').fetchone(), (1,))
+        pool.put(entry)
+        self.assertIs(pool.get(), entry)
+        stats = pool.stats()
+        self.assertEqual((stats.created, stats.checkouts, stats.in_use), (1, 2, 1))
+
+    def test_minsize_is_opened_up_front(self):
+        pool = _sqlite_pool(minsize=2, maxsize=4)
+        pool.put(pool.get())
+        stats = pool.stats()
+        self.assertEqual((stats.created, stats.size, stats.idle), (2, 2, 2))
+
+    def test_maxsize_blocks_until_timeout(self):
+        import threading
+        from tools.db import PoolTimeout
+        pool = _sqlite_pool(maxsize=1, timeout=0.1)
+        entry = pool.get()
+        with self.assertRaises(PoolTimeout):
+            pool.get()
+        # a waiter gets the connection given back meanwhile
+        threading.Timer(0.02, pool.put, (entry,)).start()
+        pool.timeout = 5
+        self.assertIs(pool.get(), entry)
+        stats = pool.stats()
+        self.assertEqual((stats.created, stats.timeouts), (1, 1))
+        self.assertGreaterEqual(stats.waits, 2)
+
+    def test_broken_connection_is_discarded(self):
+        import sqlite3
+        db = _pooled_sqlite(self)
+        db.query('SELECT 1')
+        pool = db.pool
+        self.assertEqual((pool.stats().created, pool.stats().idle), (1, 1))
+        with self.assertRaises(sqlite3.OperationalError):
+            db.query('SELECT * FROM missing')
+        stats = pool.stats()
+        self.assertEqual((stats.closed, stats.size, stats.idle), (1, 0, 0))
+        # inside a session the broken connection is dropped, the next statement gets a new one
+        with db.session():
+            with self.assertRaises(sqlite3.OperationalError):
+                db.query('SELECT * FROM missing')
+            self.assertEqual(list(db.query('SELECT 1 AS a'))[0].a, 1)
+        stats = pool.stats()
+        self.assertEqual((stats.created, stats.closed, stats.idle), (3, 2, 1))
+
+
+class EnvelopeTests(SimpleTestCase):
+    def setUp(self):
+        import decimal
+        from tools import encoder, utils
+        self.encoder = encoder
+        self.addCleanup(setattr, encoder, 'ORJSON', encoder.ORJSON)
+        self.row = utils.rowtype(['price'])((decimal.Decimal('12345678901234567.89'),))
+
+    def _check_exact(self):
+        body = self.encoder.envelope(0, 'ok', [self.row])
+        self.assertIn(b'12345678901234567.89', body)
+        self.assertIn(b'12345678901234567.89', self.encoder.envelope(0, 'ok', [self.row], columnar=True))
+        return body
+
+    def test_decimal_stdlib(self):
+        self.encoder.ORJSON = False
+        self.assertEqual(self._check_exact(),
+                         b'{"code": 0, "desc": "ok", "datas": [{"price": 12345678901234567.89}]}')
+
+    def test_decimal_orjson(self):
+        if not hasattr(self.encoder.orjson, 'Fragment'):
+            self.skipTest('orjson 3.9+ not installed')
+        self.encoder.ORJSON = True
+        self.assertEqual(self._check_exact(), b'{"code":0,"desc":"ok","datas":[{"price":12345678901234567.89}]}')
+
+    def _register(self, type, convert):
+        encoders = dict(self.encoder._encoders)
+
+        def restore():
+            self.encoder._encoders.clear()
+            self.encoder._encoders.update(encoders)
+            self.encoder._resolved.clear()
+        self.addCleanup(restore)
+        self.encoder.register_encoder(type, convert)
+
+    def test_registered_encoders_on_both_paths(self):
+        import datetime
+        import enum
+        import uuid
+        if not hasattr(self.encoder.orjson, 'Fragment'):
+            self.skipTest('orjson 3.9+ not installed')
+
+        class Code(str):
+            pass
+
+        class Kind(str, enum.Enum):
+            A = 'a'
+        self._register(datetime.datetime, lambda value: value.timestamp())
+        self._register(Code, lambda value: 'code:' + value)
+        datas = {'at': datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc),
+                 'day': datetime.date(2024, 1, 2), 'code': Code('x'), 'kind': Kind.A,
+                 'id': uuid.UUID(int=1)}
+        expected = {'at': 1704153600.0, 'day': '2024-01-02', 'code': 'code:x', 'kind': 'a',
+                    'id': '00000000-0000-0000-0000-000000000001'}
+        for orjson in (True, False):
+            self.encoder.ORJSON = orjson
+            self.assertEqual(json.loads(self.encoder.envelope(0, 'ok', datas))['datas'], expected)
+
+        self._register(uuid.UUID, lambda value: value.hex)
+        expected['id'] = '0' * 31 + '1'
+        for orjson in (True, False):
+            self.encoder.ORJSON = orjson
+            self.assertEqual(json.loads(self.encoder.envelope(0, 'ok', datas))['datas'], expected)
+
+
+class StreamTests(SimpleTestCase):
+    def setUp(self):
+        self.db = _pooled_sqlite(self)
+        self.db.query('CREATE TABLE t (a INTEGER)')
+        self.db.multiple_insert('t', [{'a': i} for i in range(10)])
+
+    def _on_thread(self, func, *args):
+        import threading
+        out = []
+        thread = threading.Thread(target=lambda: out.append(func(*args)))
+        thread.start()
+        thread.join(30)
+        return out[0]
+
+    def test_closed_on_another_thread(self):
+        rows = self.db.query('SELECT a FROM t ORDER BY a', stream=3)
+        self.assertEqual(next(rows).a, 0)
+        pool = self.db.pool
+        self.assertEqual(pool.stats().in_use, 1)
+        # the other thread has no context of its own, closing must not touch it
+        self.assertEqual(self._on_thread(lambda: (rows.close(), dict(self.db._ctx.__dict__))[1]), {})
+        self.assertEqual((pool.stats().in_use, pool.stats().idle), (0, 1))
+        self.assertNotIn('db', self.db._ctx)
+        self.assertEqual(self.db._ctx.get('pinned'), 0)
+
+    def test_stream_in_unit_of_work(self):
+        import tools
+        for unit in (tools.UnitOfWork, self.db.unit_of_work):
+            with unit():
+                self.db.insert('t', a=10)
+                self.assertEqual(len(list(self.db.query('SELECT a FROM t', stream=2))), 11)
+                self.assertEqual(self.db.pool.stats().in_use, 1)
+            self.assertEqual((self.db.pool.stats().in_use, self.db._ctx.get('db')), (0, None))
+            self.db.delete('t', where='a = 10')
+        # a stream alone in a unit gives its connection back too
+        with tools.UnitOfWork():
+            list(self.db.query('SELECT a FROM t', stream=2))
+        self.assertEqual((self.db.pool.stats().in_use, self.db._ctx.get('db')), (0, None))
+        self.assertEqual(len(self.db.select('t').list()), 10)
+
+    def test_read_on_another_thread(self):
+        rows = self.db.query('SELECT a FROM t ORDER BY a', stream=3)
+        self.assertEqual(self._on_thread(lambda: [row.a for row in rows]), list(range(10)))
+        self.assertEqual(self.db.pool.stats().in_use, 0)
+        self.assertEqual(self.db._ctx.get('pinned'), 0)
+
+
+class PreparedStatementTests(SimpleTestCase):
+    def setUp(self):
+        from tools.db import SqliteDB
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.db = SqliteDB(db=os.path.join(path, 'prepared.db'))
+        self.db.query('CREATE TABLE t (a TEXT, b INTEGER)')
+        self.db.multiple_insert('t', [{'a': 'x', 'b': 1}, {'a': 'y', 'b': 2}, {'a': 'z', 'b': 3}])
+
+    def _a(self, rows):
+        return [row.a for row in rows]
+
+    def test_scalar_binds(self):
+        select = self.db.prepare_select('t', where='b > $b AND a != $a', order='a')
+        self.assertEqual(self._a(select.execute(b=1, a='z')), ['y'])
+        self.assertEqual(self._a(select({'b': 0, 'a': 'y'})), ['x', 'z'])
+
+    def test_second_execute_reuses_the_statement(self):
+        select = self.db.prepare_select('t', where='a = $a')
+        self.assertEqual(self._a(select.execute(a='x')), ['x'])
+        statement = select.statements[0]
+        self.assertEqual(list(statement.texts.values()), ['SELECT * FROM t WHERE a = ?'])
+        # neither built nor run through select again
+        self.db.select = None
+        self.assertEqual(self._a(select.execute(a='y')), ['y'])
+        self.assertIs(self.db.prepare_select('t', where='a = $a').statements[0], statement)
+
+    def test_list_binds_fall_back(self):
+        select = self.db.prepare_select('t', where='a IN $a', order='a')
+        self.assertEqual(self._a(select.execute(a=['x', 'z'])), ['x', 'z'])
+        self.assertEqual(self._a(select.execute(a=['y'])), ['y'])
+        self.assertEqual(select.statements[0].texts, {})
+
+    def test_tuple_is_one_parameter(self):
+        import sqlite3
+        select = self.db.prepare_select('t', where='a IN $a')
+        with self.assertRaisesRegex(sqlite3.OperationalError, 'near "\\?"'):
+            list(select.execute(a=('y',)))
+
+    def test_literal_binds(self):
+        from tools.db import SQLLiteral
+        update = self.db.prepare_update('t', where='a = $a', columns=['b'])
+        self.assertEqual(update.execute(a='x', b=SQLLiteral('b + 10')), 1)
+        self.assertEqual(update.execute(a='y', b=20), 1)
+        self.assertEqual(update.statements[0].texts, {'qmark': 'UPDATE t SET b = ? WHERE a = ?'})
+        select = self.db.prepare_select('t', what='b', where='a = $a OR b = $b', order='b')
+        self.assertEqual([row.b for row in select.execute(a='z', b=SQLLiteral('11'))], [3, 11])
+        self.assertEqual([row.b for row in self.db.select('t', what='b', order='b')], [3, 11, 20])
+
+    def test_insert(self):
+        insert = self.db.prepare_insert('t', ['a', 'b'])
+        first = insert.execute(a='v', b=4)
+        self.assertEqual(insert.execute({'a': 'w', 'b': 5}), first + 1)
+        self.assertEqual(self._a(self.db.select('t', where='b >= 4', order='b')), ['v', 'w'])
+
+
+class DatabaseTests(SimpleTestCase):
+    def test_callers_get_their_own_copy(self):
+        import tools
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        first = tools.database(dbn='sqlite', db=os.path.join(path, 'shared.db'))
+        first.printing = first.supports_multiple_insert = True
+        second = tools.database(dbn='sqlite', db=os.path.join(path, 'shared.db'))
+        self.assertIsNot(first, second)
+        self.assertEqual((second.printing, second.supports_multiple_insert), (False, False))
+        self.assertIs(first._ctx, second._ctx)
+        self.assertIs(first._prepared, second._prepared)
+
+
+class ThreadedDictTests(SimpleTestCase):
+    def _on_thread(self, func):
+        import threading
+        thread = threading.Thread(target=func)
+        thread.start()
+        thread.join(30)
+
+    def test_threaded_dict_is_shared_by_threads(self):
+        # as before: the values are the same in every thread, clear_all clears them for all
+        from tools.utils import ThreadedDict
+        d = ThreadedDict()
+        d.a = 1
+        self._on_thread(lambda: d.__setitem__('b', 2))
+        self.assertEqual(sorted(d.keys()), ['a', 'b'])
+        self._on_thread(ThreadedDict.clear_all)
+        self.assertEqual(list(d.items()), [])
+
+    def test_db_contexts_are_thread_local(self):
+        from tools.utils import ThreadLocalDict
+        d = ThreadLocalDict()
+        d.a = 1
+        seen = []
+        self._on_thread(lambda: (d.__setitem__('b', 2), seen.append(sorted(d.keys()))))
+        self.assertEqual((seen, list(d.keys())), ([['b']], ['a']))
+        self._on_thread(ThreadLocalDict.clear_all)
+        self.assertEqual(d.a, 1)
+
+
+class BoundDBTests(SimpleTestCase):
+    def setUp(self):
+        self.db = _pooled_sqlite(self)
+        self.db.query('CREATE TABLE t (a INTEGER)')
+
+    def test_transaction_commits_and_releases(self):
+        bound = self.db.bind()
+        transaction = bound.transaction()
+        bound.insert('t', a=1)
+        self.assertEqual(self.db.pool.stats().in_use, 1)
+        transaction.commit()
+        self.assertEqual((self.db.pool.stats().in_use, bound._ctx.get('db')), (0, None))
+        self.assertEqual([row.a for row in self.db.select('t')], [1])
+
+    def test_rollback(self):
+        bound = self.db.bind()
+        transaction = bound.transaction()
+        bound.insert('t', a=1)
+        transaction.rollback()
+        self.assertEqual(self.db.pool.stats().in_use, 0)
+        self.assertEqual(list(self.db.select('t')), [])
+
+    def test_session_and_stream(self):
+        bound = self.db.bind()
+        with bound.session():
+            bound.insert('t', a=1)
+            bound.insert('t', a=2)
+            self.assertEqual([row.a for row in bound.query('SELECT a FROM t ORDER BY a', stream=1)], [1, 2])
+        self.assertEqual(self.db.pool.stats().in_use, 0)
+        # the thread context of the DB it was bound from stays untouched
+        self.assertNotIn('pinned', self.db._ctx)
+
+
+class RequestDBTests(SimpleTestCase):
+    def setUp(self):
+        from django.test import Client
+        _sqlite_conf(self, 'DB')
+        _conf_db('DB').query('CREATE TABLE t (a INTEGER)')
+        _scripts(self, **{
+            'test/write': """
+                import tools
+                from django.http import HttpResponse
+
+                def run(request, param):
+                    request.db.insert('t', a=int(param['a']))
+                    if param.get('fail') == 'raise':
+                        raise ValueError('failed')
+                    if param.get('fail') == '5xx':
+                        return HttpResponse('unavailable', status=503)
+                    return tools.response(0, '', request.db.select('t', what='count(*) AS n')[0].n)
+            """})
+        self.client = Client(raise_request_exception=False)
+
+    def _rows(self):
+        return [row.a for row in _conf_db('DB').select('t', order='a')]
+
+    def test_commit_on_2xx(self):
+        response = self.client.get('/test/write', {'a': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['datas'], 1)
+        self.assertEqual(self._rows(), [1])
+        self.assertEqual(_conf_db('DB').pool.stats().in_use, 0)
+
+    def test_rollback_on_exception(self):
+        self.assertEqual(self.client.get('/test/write', {'a': 1, 'fail': 'raise'}).status_code, 500)
+        self.assertEqual(self._rows(), [])
+        self.assertEqual(_conf_db('DB').pool.stats().in_use, 0)
+
+    def test_rollback_on_5xx(self):
+        self.assertEqual(self.client.get('/test/write', {'a': 1, 'fail': '5xx'}).status_code, 503)
+        self.client.get('/test/write', {'a': 2})
+        self.assertEqual(self._rows(), [2])
+
+
+class ASGIRequestDBTests(SimpleTestCase):
+    """the same middleware stack served through the ASGI dispatcher"""
+    def setUp(self):
+        from django.test import AsyncClient
+        _sqlite_conf(self, 'DB')
+        _conf_db('DB').query('CREATE TABLE t (a INTEGER)')
+        _scripts(self, **{
+            'test/sleep': """
+                import asyncio
+                import tools
+
+                async def run(request, param):
+                    await asyncio.sleep(0.3)
+                    return tools.response(0, '')
+            """,
+            'test/write': """
+                import tools
+
+                def run(request, param):
+                    request.db.insert('t', a=int(param['a']))
+                    if param.get('fail'):
+                        raise ValueError('failed')
+                    return tools.response(0, '')
+            """})
+        self.client = AsyncClient(raise_request_exception=False)
+        override = self.settings(ROOT_URLCONF='app.tests')
+        override.enable()
+        self.addCleanup(override.disable)
+
+    async def test_async_views_run_concurrently(self):
+        import asyncio
+        start = time.time()
+        responses = await asyncio.gather(*[self.client.get('/test/sleep') for _ in range(4)])
+        self.assertEqual([r.status_code for r in responses], [200] * 4)
+        # one at a time would take 1.2 s
+        self.assertLess(time.time() - start, 0.9)
+
+    async def test_commit_and_rollback(self):
+        self.assertEqual((await self.client.get('/test/write?a=1')).status_code, 200)
+        self.assertEqual((await self.client.get('/test/write?a=2&fail=1')).status_code, 500)
+        import tools
+        rows = await tools.run_sync(lambda: [row.a for row in _conf_db('DB').select('t')])
+        self.assertEqual(rows, [1])
+
+
+# the ASGI dispatcher, for ASGIRequestDBTests
+urlpatterns = [re_path('.*', views.ainterface)]
+
+
+class _FakeMySQLCursor(object):
+    """the part of a mysql.connector cursor tools.db uses"""
+    def __init__(self, conn, options):
+        self.conn = conn
+        self.options = options
+        self.description = None
+        self.rowcount = 0
+        self._rows = []
+
+    def execute(self, query, params=()):
+        # like mysql.connector: a plain cursor interpolates %s, only a prepared one takes ?
+        marker = '?' if self.options.get('prepared') else '%s'
+        if params and query.count(marker) != len(params):
+            raise self.conn.module.ProgrammingError('Not all parameters were used in the SQL statement')
+        self.conn.executed.append((query, list(params or ()), self.options))
+        self.description = [('a',)]
+        self._rows = [(1,), (2,), (3,)]
+
+    def fetchmany(self, size=None):
+        rows, self._rows = self._rows[:size or self.arraysize], self._rows[size or self.arraysize:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class _FakeMySQLConnection(object):
+    def __init__(self, module):
+        self.module = module
+        self.executed = module.executed
+
+    def cursor(self, **options):
+        return _FakeMySQLCursor(self, options)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MySQLStreamTests(SimpleTestCase):
+    def setUp(self):
+        import types
+        from unittest import mock
+        connector = types.ModuleType('mysql.connector')
+        connector.paramstyle = 'pyformat'
+        connector.executed = []
+        connector.ProgrammingError = type('ProgrammingError', (Exception,), {})
+        connector.connect = lambda **keywords: _FakeMySQLConnection(connector)
+        package = types.ModuleType('mysql')
+        package.connector = connector
+        patch = mock.patch.dict(sys.modules, {'mysql': package, 'mysql.connector': connector})
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.connector = connector
+
+    def _db(self, **keywords):
+        from tools.db import MySQLDB
+        return MySQLDB(driver='mysql.connector', host='fake', db='stream%d' % len(keywords), user='u', pw='p',
+                       **keywords)
+
+    def test_stream_with_statement_cache(self):
+        db = self._db(statement_cache=16)
+        self.assertEqual(db.paramstyle, 'qmark')
+        rows = db.query('SELECT a FROM t WHERE b = $b', vars={'b': 1}, stream=2)
+        self.assertEqual([row.a for row in rows], [1, 2, 3])
+        self.assertEqual(self.connector.executed, [('SELECT a FROM t WHERE b = ?', [1], {'prepared': True})])
+
+    def test_stream_without_statement_cache(self):
+        db = self._db()
+        rows = db.query('SELECT a FROM t WHERE b = $b', vars={'b': 1}, stream=2)
+        self.assertEqual([row.a for row in rows], [1, 2, 3])
+        self.assertEqual(self.connector.executed, [('SELECT a FROM t WHERE b = %s', [1], {'buffered': False})])
+
+
+class UnitOfWorkTests(SimpleTestCase):
+    def setUp(self):
+        self.db = _pooled_sqlite(self)
+        self.db.query('CREATE TABLE t (a INTEGER PRIMARY KEY)')
+
+    def _rows(self):
+        return [row.a for row in self.db.select('t', order='a')]
+
+    def test_one_commit(self):
+        import tools
+        with tools.UnitOfWork():
+            self.db.insert('t', a=1)
+            self.db.insert('t', a=2)
+            self.assertEqual(self.db.pool.stats().in_use, 1)
+        self.assertEqual(self._rows(), [1, 2])
+        self.assertEqual(self.db.pool.stats().in_use, 0)
+
+    def test_failed_statement_propagating(self):
+        import sqlite3
+        import tools
+        with self.assertRaises(sqlite3.IntegrityError):
+            with tools.UnitOfWork():
+                self.db.insert('t', a=1)
+                self.db.insert('t', a=1)
+        self.assertEqual(self._rows(), [])
+
+    def test_failed_statement_caught(self):
+        import sqlite3
+        import tools
+        with self.assertRaises(tools.UnitOfWorkError) as caught:
+            with self.db.unit_of_work():
+                self.db.insert('t', a=1)
+                self.db.insert('t', a=2)
+                try:
+                    self.db.insert('t', a=2)
+                except sqlite3.IntegrityError:
+                    pass
+                self.db.insert('t', a=3)
+        # the two statements deferred before the failure are gone, the unit commits nothing after it
+        self.assertEqual((caught.exception.lost, caught.exception.query), (2, 'INSERT INTO t (a) VALUES (?)'))
+        self.assertIsInstance(caught.exception.__cause__, sqlite3.IntegrityError)
+        self.assertEqual(self._rows(), [])
+        self.assertEqual(self.db.pool.stats().in_use, 0)
+
+    def test_failed_statement_in_inner_unit(self):
+        import sqlite3
+        import tools
+        with self.assertRaises(tools.UnitOfWorkError):
+            with tools.UnitOfWork():
+                self.db.insert('t', a=1)
+                with tools.UnitOfWork():
+                    self.db.insert('t', a=2)
+                with tools.UnitOfWork():
+                    with self.assertRaises(sqlite3.IntegrityError):
+                        self.db.insert('t', a=2)
+        self.assertEqual(self._rows(), [])
+
+
+class DatasourceTests(SimpleTestCase):
+    def setUp(self):
+        self.root = _sqlite_conf(self, 'DB', 'OTHER')
+        self.conf = os.path.join(self.root, 'conf.ini')
+
+    def _edit_conf(self, section, line):
+        from tools import accutils
+        with open(self.conf) as f:
+            text = f.read()
+        with open(self.conf, 'w') as f:
+            f.write(text.replace('[%s]\n' % section, '[%s]\n%s\n' % (section, line)))
+        os.utime(self.conf, (time.time() + 10, time.time() + 10))
+        accutils._conf.checked = 0
+
+    def test_conf_is_read_once(self):
+        import tools
+        state, first = tools.getDBConf('DB')
+        self.assertTrue(state)
+        self.assertIs(tools.getDBConf('DB')[1], first)
+        self.assertEqual(first.key, tools.getDBConf('DB')[1].key)
+        self.assertEqual(tools.getDBConf('MISSING')[0], False)
+
+    def test_old_pool_closed_when_its_section_changes(self):
+        import tools
+        old = _conf_db('DB')
+        held = old.bind()
+        held.transaction()  # a request still running on the old datasource
+        old.query('SELECT 1')
+        old_pool = old.pool
+        other = _conf_db('OTHER')
+        other.query('SELECT 1')
+        self.assertEqual((old_pool.stats().idle, old_pool.stats().in_use), (1, 1))
+
+        self._edit_conf('DB', 'POOL_MAX=5')
+        new = _conf_db('DB')
+        self.assertTrue(old_pool.closed)
+        self.assertEqual((old_pool.stats().idle, old_pool.stats().closed), (0, 1))
+        # the connection in use goes back to its own, closed, pool
+        held.ctx.transactions[-1].commit()
+        self.assertEqual((old_pool.stats().size, old_pool.stats().closed), (0, 2))
+
+        new.query('SELECT 1')
+        self.assertIsNot(new.pool, old_pool)
+        self.assertEqual(new.pool.maxsize, 5)
+        # the section left alone keeps its pool
+        self.assertFalse(other.pool.closed)
+        self.assertNotIn(old_pool, tools.db._pools.values())
+
+    def test_same_params_reopen_a_pool(self):
+        from tools import accutils
+        old = _conf_db('DB')
+        old.query('SELECT 1')
+        old_pool = old.pool
+        self._edit_conf('DB', 'POOL_MAX=5')
+        _conf_db('DB')
+        # back to the first params: a fresh pool, not the closed one
+        with open(self.conf) as f:
+            text = f.read()
+        with open(self.conf, 'w') as f:
+            f.write(text.replace('POOL_MAX=5\n', ''))
+        os.utime(self.conf, (time.time() + 20, time.time() + 20))
+        accutils._conf.checked = 0
+        again = _conf_db('DB')
+        again.query('SELECT 1')
+        self.assertIsNot(again.pool, old_pool)
+        self.assertFalse(again.pool.closed)
+
+
+class RegistryTests(SimpleTestCase):
+    def test_scan(self):
+        from . import registry
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for name in ('a/b.py', 'a/b.pyc', 'a/c.pyc', 'a/__pycache__/b.cpython-311.pyc', 'a/notes.txt', 'd.py'):
+            path = os.path.join(root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+        self.assertEqual(registry.scan(root), {'a/b': os.path.join(root, 'a', 'b.py'),
+                                               'a/c': os.path.join(root, 'a', 'c.pyc'),
+                                               'd': os.path.join(root, 'd.py')})
+
+    def test_load_imports_every_script_once(self):
+        from . import registry
+        self.addCleanup(setattr, registry, '_endpoints', registry._endpoints)
+        endpoints = registry.load()
+        self.assertEqual(set(endpoints), set(registry.scan()))
+        endpoint = registry.get('example/parseParam')
+        self.assertIs(endpoint.module, sys.modules['api.example.parseParam'])
+        self.assertIs(endpoint.run, endpoint.module.run)
+        self.assertIsNone(registry.get('example/missing'))
+
+    def test_requests_resolve_from_the_registry(self):
+        from django.test import Client
+        endpoints = _scripts(self, **{
+            'test/hello': """
+                import tools
+
+                def run(request, param):
+                    return tools.response(0, 'hello', param)
+            """,
+            'test/norun': """
+                RUN = None
+            """})
+        # served from memory, the file is no longer looked at
+        os.remove(endpoints['test/hello'].path)
+        client = Client()
+        self.assertEqual(json.loads(client.get('/test/hello', {'a': '1'}).content),
+                         {'code': 0, 'desc': 'success hello', 'datas': {'a': '1'}})
+        self.assertEqual(json.loads(client.get('/test/norun').content)['code'], -3)
+        self.assertEqual(json.loads(client.get('/test/missing').content)['code'], -2)
+
+
+class HotReloadTests(SimpleTestCase):
+    def setUp(self):
+        from . import registry
+        self.registry = registry
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.mkdir(os.path.join(self.root, 'test'))
+        self.path = os.path.join(self.root, 'test', 'hot.py')
+        # refresh drops what isn't under `root`, start from an empty registry
+        self.addCleanup(setattr, registry, '_endpoints', registry._endpoints)
+        self.addCleanup(sys.modules.pop, 'api.test.hot', None)
+        registry._endpoints = {}
+        self.mtime = time.time()
+
+    def _write(self, source):
+        with open(self.path, 'w') as f:
+            f.write(source)
+        self.mtime += 10
+        os.utime(self.path, (self.mtime, self.mtime))
+
+    def test_off_outside_runserver(self):
+        import subprocess
+        env = dict(os.environ)
+        env.pop('ACCURAD_API_RELOAD', None)
+        code = 'from AccuradSite import settings; print(settings.API_RELOAD_INTERVAL)'
+        for argv, interval in (([], '0.0'), (['runserver'], '2.0')):
+            out = subprocess.check_output([sys.executable, '-c', code] + argv, env=env,
+                                          cwd=os.path.dirname(os.path.dirname(__file__)))
+            self.assertEqual(out.decode().split()[-1], interval)
+
+        from AccuradSite import settings
+        self.addCleanup(setattr, settings, 'API_RELOAD_INTERVAL', settings.API_RELOAD_INTERVAL)
+        settings.API_RELOAD_INTERVAL = 0
+        self.assertIsNone(self.registry.watch())
+
+    def test_refresh(self):
+        registry = self.registry
+        self._write('def run(request, param):\n    return 1\n')
+        self.assertEqual(registry.refresh(self.root), ['test/hot'])
+        old = registry.get('test/hot')
+        self.assertEqual(old.run(None, None), 1)
+        self.assertEqual(registry.refresh(self.root), [])
+
+        self._write('def run(request, param):\n    return 2\n')
+        self.assertEqual(registry.refresh(self.root), ['test/hot'])
+        self.assertEqual(registry.get('test/hot').run(None, None), 2)
+        # a request that started before keeps its version
+        self.assertEqual(old.run(None, None), 1)
+
+        # a broken edit keeps the working version
+        self._write('def run(request, param)\n')
+        self.assertEqual(registry.refresh(self.root), [])
+        self.assertEqual(registry.get('test/hot').run(None, None), 2)
+
+        os.remove(self.path)
+        self.assertEqual(registry.refresh(self.root), ['test/hot'])
+        self.assertIsNone(registry.get('test/hot'))
+
+    def test_watcher(self):
+        self._write('def run(request, param):\n    return 1\n')
+        watcher = self.registry.Watcher(0.05, self.root)
+        watcher.start()
+        self.addCleanup(watcher.join)
+        self.addCleanup(watcher.stop)
+        for _ in range(100):
+            if self.registry.get('test/hot') is not None:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.registry.get('test/hot').run(None, None), 1)
+
+
+class AsyncDispatchTests(SimpleTestCase):
+    def setUp(self):
+        _scripts(self, **{
+            'test/async': """
+                import asyncio
+                import threading
+                import tools
+
+                async def run(request, param):
+                    await asyncio.sleep(0)
+                    return tools.response(0, '', threading.current_thread().name)
+            """,
+            'test/sync': """
+                import threading
+                import tools
+
+                def run(request, param):
+                    return tools.response(0, '', threading.current_thread().name)
+            """})
+
+    def _thread(self, response):
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)['datas']
+
+    async def test_ainterface(self):
+        import threading
+        from django.test import AsyncClient
+        client = AsyncClient()
+        with self.settings(ROOT_URLCONF='app.tests'):
+            # the coroutine is awaited on the event loop, the sync script sent to the executor
+            self.assertEqual(self._thread(await client.get('/test/async')), threading.current_thread().name)
+            self.assertTrue(self._thread(await client.get('/test/sync')).startswith('api-run'))
+
+    def test_interface_runs_coroutines(self):
+        import threading
+        from django.test import Client
+        self.assertEqual(self._thread(Client().get('/test/async')), threading.current_thread().name)
+
+
+class ForkTests(SimpleTestCase):
+    def test_child_drops_the_parent_connections(self):
+        db = _pooled_sqlite(self)
+        db.query('SELECT 1')
+        transaction = db.transaction()
+        parent = db._ctx.pool_entry
+        out = multiprocessing.get_context('fork').Queue()
+        child = multiprocessing.get_context('fork').Process(target=_forked_worker, args=(db, parent, out))
+        child.start()
+        fresh, created, size, own_pool, inherited = out.get(timeout=30)
+        child.join(30)
+        self.assertEqual(child.exitcode, 0)
+        # the child's thread context was cleared and its pool started over
+        self.assertTrue(fresh)
+        self.assertEqual((created, size), (1, 1))
+        self.assertTrue(own_pool)
+        self.assertTrue(inherited)
+
+        # the parent goes on with its connection
+        db.query('SELECT 1')
+        self.assertIs(db._ctx.pool_entry, parent)
+        transaction.commit()
+        self.assertEqual((db.pool.stats().in_use, db.pool.stats().created), (0, 1))
+
+
+class ReparamCacheTests(SimpleTestCase):
+    def setUp(self):
+        from tools import db
+        from tools.utils import LRU
+        self.db = db
+        self.addCleanup(setattr, db, '_templates', db._templates)
+        db._templates = LRU(2)
+        parses = self.parses = []
+        Parser = db.Parser
+
+        class CountingParser(Parser):
+            def parse(self, text):
+                parses.append(text)
+                return Parser.parse(self, text)
+        self.addCleanup(setattr, db, 'Parser', Parser)
+        db.Parser = CountingParser
+
+    def test_template_parsed_once(self):
+        reparam = self.db.reparam
+        query = reparam('id = $id AND name = $o.name', {'id': 1, 'o': self.db.storage(name='a')})
+        self.assertEqual((query.query(), query.values()), ('id = %s AND name = %s', [1, 'a']))
+        # the cached tree is bound to the vars of each call
+        query = reparam('id = $id AND name = $o.name', {'id': 2, 'o': self.db.storage(name='b')})
+        self.assertEqual((query.query(), query.values()), ('id = %s AND name = %s', [2, 'b']))
+        self.assertEqual(self.parses, ['id = $id AND name = $o.name'])
+        self.assertEqual(self.db._templates.stats().hits, 1)
+
+    def test_least_recently_used_dropped(self):
+        reparam = self.db.reparam
+        for text in ('a = $x', 'b = $x', 'a = $x', 'c = $x', 'a = $x', 'b = $x'):
+            reparam(text, {'x': 1})
+        # 'b' was the least recently used when 'c' came in
+        self.assertEqual(self.parses, ['a = $x', 'b = $x', 'c = $x', 'b = $x'])
+        self.assertEqual(len(self.db._templates), 2)
+
+
+class ColumnarTests(SimpleTestCase):
+    def setUp(self):
+        from django.test import Client
+        from tools import encoder
+        self.encoder = encoder
+        self.addCleanup(setattr, encoder, 'ORJSON', encoder.ORJSON)
+        _sqlite_conf(self, 'DB')
+        db = _conf_db('DB')
+        db.query('CREATE TABLE t (a INTEGER, b TEXT)')
+        db.multiple_insert('t', [{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}])
+        script = """
+            import tools
+
+            def run(request, param):
+                db = tools.database(tools.getDBConf('DB')[1])
+                return tools.response(0, '', {'params': param, 't': db.select('t', order='a')})
+        """
+        _scripts(self, **{'test/rows': script, 'test/columns': script.replace('import tools', "import tools\n            RESPONSE_FORMAT = 'columnar'")})
+        self.client = Client()
+
+    def _datas(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)['datas']
+
+    def test_layouts(self):
+        rows = {'params': None, 't': [{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}]}
+        columns = {'params': None, 't': {'columns': ['a', 'b'], 'rows': [[1, 'x'], [2, 'y']]}}
+        for orjson in (False, True):
+            self.encoder.ORJSON = orjson and self.encoder.orjson is not None
+            self.assertEqual(self._datas('/test/rows'), rows)
+            # the parameter is for the dispatcher, the script doesn't see it
+            self.assertEqual(self._datas('/test/rows', _format='columnar'), columns)
+            self.assertEqual(self._datas('/test/columns'), columns)
+            self.assertEqual(self._datas('/test/columns', _format='rows'), rows)
+            # an unknown format gives the default layout
+            self.assertEqual(self._datas('/test/columns', _format='other', a='1'),
+                             dict(rows, params={'a': '1'}))
+
+
+class NegotiationTests(SimpleTestCase):
+    def setUp(self):
+        from django.test import Client
+        _scripts(self, **{'test/values': """
+            import datetime
+            import decimal
+            import tools
+
+            def run(request, param):
+                return tools.response(0, '', {'price': decimal.Decimal('1.25'), 'data': b'\\x00\\x01',
+                                              'day': datetime.date(2024, 1, 2)})
+        """})
+        self.client = Client()
+
+    def test_json_by_default(self):
+        for accept in ('', 'text/html, */*;q=0.1', 'application/msgpack;q=0'):
+            response = self.client.get('/test/values', HTTP_ACCEPT=accept)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            self.assertIn('Accept', response['Vary'])
+            self.assertEqual(json.loads(response.content)['datas'],
+                             {'price': 1.25, 'data': 'AAE=', 'day': '2024-01-02'})
+
+    def test_msgpack(self):
+        try:
+            import msgpack
+        except ImportError:
+            self.skipTest('msgpack not installed')
+        for accept in ('application/msgpack', 'application/x-msgpack', 'application/json;q=0.5, application/msgpack'):
+            response = self.client.get('/test/values', HTTP_ACCEPT=accept)
+            self.assertEqual(response['Content-Type'], 'application/msgpack')
+            self.assertEqual(msgpack.unpackb(response.content)['datas'],
+                             {'price': 1.25, 'data': b'\x00\x01', 'day': '2024-01-02'})
+
+    def test_cbor(self):
+        import decimal
+        try:
+            import cbor2
+        except ImportError:
+            self.skipTest('cbor2 not installed')
+        response = self.client.get('/test/values', HTTP_ACCEPT='application/cbor')
+        self.assertEqual(response['Content-Type'], 'application/cbor')
+        self.assertEqual(cbor2.loads(response.content)['datas'],
+                         {'price': decimal.Decimal('1.25'), 'data': b'\x00\x01', 'day': '2024-01-02'})
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        from django.test import Client
+        from . import cache
+        self.addCleanup(setattr, cache, '_cache', cache._cache)
+        cache._cache = self.cache = cache.ResponseCache(1 << 20)
+        endpoints = _scripts(self, **{
+            'test/cached': """
+                import threading
+                import tools
+
+                CACHE = {'ttl': 0.2, 'key': ('a',), 'stale': 30}
+                calls = []
+                release = threading.Event()
+
+                def run(request, param):
+                    calls.append(param)
+                    if len(calls) == 3:
+                        release.wait(10)
+                    return tools.response(0 if param.get('a') != 'fail' else -1, '', len(calls))
+            """})
+        self.script = endpoints['test/cached'].module
+        self.client = Client()
+
+    def _get(self, **params):
+        return json.loads(self.client.get('/test/cached', params).content)['datas']
+
+    def test_hits(self):
+        self.script.release.set()
+        self.assertEqual(self._get(a='1'), 1)
+        # only the key parameters tell responses apart
+        self.assertEqual(self._get(a='1', b='other'), 1)
+        self.assertEqual(self._get(a='2'), 2)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        # other layouts and media types, failures and POSTs are not served from it
+        self.assertEqual(self._get(a='1', _format='columnar'), 3)
+        self.assertEqual(self._get(a='fail'), 4)
+        self.assertEqual(self._get(a='fail'), 5)
+        self.client.post('/test/cached', json.dumps({'a': '1'}), content_type='application/json')
+        self.assertEqual(len(self.script.calls), 6)
+
+    def test_stale_while_revalidate(self):
+        import threading
+        self.assertEqual(self._get(a='1'), 1)
+        self.script.calls.append({})  # the next run is the one that blocks
+        time.sleep(0.25)
+        refreshed = []
+        leader = threading.Thread(target=lambda: refreshed.append(self._get(a='1')))
+        leader.start()
+        for _ in range(100):
+            if len(self.script.calls) == 3:
+                break
+            time.sleep(0.01)
+        # expired, one request is refreshing it: the others get the old response
+        self.assertEqual(self._get(a='1'), 1)
+        self.script.release.set()
+        leader.join(10)
+        self.assertEqual(refreshed, [3])
+        self.assertEqual(self._get(a='1'), 3)
+        # the lookup of the request refreshing it and the one served stale
+        self.assertEqual(self.cache.stale, 2)
+
+
+class CoalesceTests(SimpleTestCase):
+    def setUp(self):
+        from django.test import Client
+        endpoints = _scripts(self, **{
+            'test/coalesced': """
+                import threading
+                import tools
+
+                COALESCE = True
+                calls = []
+                release = threading.Event()
+
+                def run(request, param):
+                    calls.append(param)
+                    n = len(calls)
+                    release.wait(10)
+                    return tools.response(-1 if param.get('fail') else 0, '', n)
+            """})
+        self.script = endpoints['test/coalesced'].module
+        self.client = Client()
+
+    def _get(self, url):
+        return json.loads(self.client.get(url).content)
+
+    def _concurrent(self, urls):
+        import threading
+        results = [None] * len(urls)
+
+        def get(i):
+            results[i] = self._get(urls[i])
+        threads = [threading.Thread(target=get, args=(i,)) for i in range(len(urls))]
+        for thread in threads:
+            thread.start()
+        # the leaders are running, the others are waiting on them
+        time.sleep(0.2)
+        self.script.release.set()
+        for thread in threads:
+            thread.join(10)
+        self.script.release.clear()
+        return results
+
+    def test_identical_requests_share_one_run(self):
+        results = self._concurrent(['/test/coalesced?a=1'] * 4 + ['/test/coalesced?a=2'])
+        self.assertEqual(len(self.script.calls), 2)
+        self.assertEqual(len(set(r['datas'] for r in results[:4])), 1)
+        self.assertNotEqual(results[4]['datas'], results[0]['datas'])
+
+    def test_failures_shared_nothing_kept(self):
+        results = self._concurrent(['/test/coalesced?fail=1'] * 3)
+        self.assertEqual([r['code'] for r in results], [-1] * 3)
+        self.assertEqual(len(self.script.calls), 1)
+        # once sent, the next request runs the script again
+        self.script.release.set()
+        self.assertEqual(self._get('/test/coalesced?fail=1')['datas'], 2)
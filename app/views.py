@@ -1,28 +1,30 @@
-from AccuradSite import settings
-import importlib
-import os
+import asyncio
 import json
 import tools
+from . import cache, registry
 
 
-# Create your views here.
-def interface(request):
+def resolve(request):
+    """Returns (endpoint, None), or (None, error response) when the url can't be served."""
     name = request.path.lstrip("/")
     if name is None or name == "":
-        return tools.response(-2, "the sub url is not gived! [%s]" % name)
-    apiPath = os.path.join(settings.BASE_DIR, "api", name + ".py")
-    print(apiPath)
-    if not os.path.exists(apiPath) or os.path.isdir(apiPath):
-        if not os.path.exists(apiPath + "c") or os.path.isdir(apiPath + "c"):
-            return tools.response(-2, "the sub url is not give resolve! [%s]" % name)
-    name = "api." + str(name).lstrip("/").replace("/", ".")
-    lib = importlib.import_module(name)
-    if not hasattr(lib, 'run'):
-        return tools.response(-3, "there's no entry 'run' in [%s]" % name)
+        return None, tools.response(-2, "the sub url is not gived! [%s]" % name)
+    endpoint = registry.get(name)
+    if endpoint is None:
+        return None, tools.response(-2, "the sub url is not give resolve! [%s]" % name)
+    if endpoint.error is not None:
+        return None, tools.response(-3, "[%s] %s" % (registry.modname(name), endpoint.error))
+    if endpoint.run is None:
+        return None, tools.response(-3, "there's no entry 'run' in [%s]" % registry.modname(name))
+    return endpoint, None
+
 
+def parse_params(request):
     parms = {}
     if request.method == "GET":
         for key in request.GET.keys():
+            if key == tools.FORMAT_PARAM:
+                continue
             parms[key] = request.GET.get(key)
     else:
         parms = request.body.decode("utf-8")
@@ -33,8 +35,42 @@ def interface(request):
         parms = json.loads(parms)
     if parms == "" or parms is None or len(parms) == 0:
         parms = None
+    return parms
+
+
+def call(endpoint, request, parms):
+    """Runs a sync script, inside a unit of work when it asks for one."""
+    if endpoint.unit_of_work:
+        with tools.UnitOfWork():
+            return endpoint.run(request, parms)
+    return endpoint.run(request, parms)
+
+
+# Create your views here.
+def interface(request):
+    endpoint, error = resolve(request)
+    if error is not None:
+        return error
+    request.endpoint = endpoint
+    parms = parse_params(request)
 
-    return lib.run(request, parms)
+    with tools.serving(request):
+        if endpoint.coroutine:
+            # async script served by a sync worker
+            return cache.serve(endpoint, request, parms, lambda: asyncio.run(endpoint.run(request, parms)))
+        return cache.serve(endpoint, request, parms, lambda: call(endpoint, request, parms))
 
 
+async def ainterface(request):
+    """ASGI dispatcher: awaits `async def run` scripts on the event loop and
+    hands sync ones to the bounded pool of tools.executor()."""
+    endpoint, error = resolve(request)
+    if error is not None:
+        return error
+    request.endpoint = endpoint
+    parms = parse_params(request)
 
+    with tools.serving(request):
+        if endpoint.coroutine:
+            return await cache.aserve(endpoint, request, parms, lambda: endpoint.run(request, parms))
+        return await tools.run_sync(cache.serve, endpoint, request, parms, lambda: call(endpoint, request, parms))
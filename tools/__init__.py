@@ -4,9 +4,10 @@
 from __future__ import generators
 
 
-from . import utils, db
+from . import utils, db, metrics, encoder
 
 from .utils import *
 from .db import *
 from .accutils import *
 from .globalvar import *
+from .encoder import *
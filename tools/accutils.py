@@ -5,18 +5,104 @@ import json
 import ctypes
 import os
 import configparser
+import asyncio
+import contextlib
+import contextvars
+import functools
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from AccuradSite import settings
 from django.shortcuts import render as rd, HttpResponse
+from django.utils.cache import patch_vary_headers
 from suds.client import Client
 import tools
+from .utils import storage, Row
+from . import encoder
 
 
 def response(code, subdesc='', message=''):
-    jsonObject = {}
-    jsonObject['code'] = code
-    jsonObject['desc'] = tools.ERROR_CODE[str(code)] + " " + subdesc
-    jsonObject['datas'] = message
-    return HttpResponse(json.dumps(jsonObject), content_type="application/json")
+    # message may be a query result as is (rows, iterbetter, stream), encoded without a dict per row
+    # JSON unless the Accept header of the request asks for MessagePack / CBOR
+    desc = tools.ERROR_CODE[str(code)] + " " + subdesc
+    request = current_request()
+    columnar = response_format(request) == 'columnar'
+    content_type, body = encoder.pack(accepted_type(request), code, desc, message, columnar)
+    resp = HttpResponse(body, content_type=content_type)
+    patch_vary_headers(resp, ('Accept',))
+    resp.code = code  # only code 0 responses are kept by the response cache (app/cache.py)
+    return resp
+
+
+FORMAT_PARAM = '_format'
+RESPONSE_FORMATS = ('rows', 'columnar')
+
+_current_request = contextvars.ContextVar('request', default=None)
+
+
+@contextlib.contextmanager
+def serving(request):
+    """makes `request` the one current_request() returns, for the api dispatcher"""
+    token = _current_request.set(request)
+    try:
+        yield request
+    finally:
+        _current_request.reset(token)
+
+
+def current_request():
+    """the request the api dispatcher is serving in this thread/task, None outside of one"""
+    return _current_request.get()
+
+
+def response_format(request=None):
+    """
+    How tools.response lays out result sets: 'rows', a list of objects, or
+    'columnar', {"columns": [...], "rows": [[...], ...]}. Taken from the
+    `_format` parameter of the request, else the RESPONSE_FORMAT of its script.
+    """
+    request = request or current_request()
+    if request is None:
+        return 'rows'
+    format = request.GET.get(FORMAT_PARAM)
+    if not format:
+        endpoint = getattr(request, 'endpoint', None)
+        format = endpoint and endpoint.response_format
+    return format if format in RESPONSE_FORMATS else 'rows'
+
+
+def accepted_type(request=None):
+    """the media type tools.response answers with, negotiated from the Accept header of the request"""
+    request = request or current_request()
+    if request is None:
+        return encoder.JSON
+    return encoder.negotiate(request.META.get('HTTP_ACCEPT', ''))
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    """bounded thread pool running sync scripts under ASGI, sized by settings.ASYNC_THREADS"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'ASYNC_THREADS', 32),
+                                               thread_name_prefix="api-run")
+    return _executor
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    await a blocking call (db, soap...) from an `async def run` script
+    without stalling the event loop, e.g. `rows = await tools.run_sync(db.select, "test")`
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await loop.run_in_executor(executor(), call)
 
 
 def response_html(message=''):
@@ -54,6 +140,9 @@ def storage2Json(Storage):
         return None
     try:
         for k, item in enumerate(Storage):
+            if isinstance(item, Row):
+                ret.append(item.todict())
+                continue
             obj = {}
             for k, v in enumerate(item):
                 obj[v] = item[v]
@@ -109,9 +198,107 @@ def dictreverse(mapping):
     return dict([(value, key) for (key, value) in iteritems(mapping)])
 
 
-def getDBConf(type):
+CONF_FILE = os.path.join(settings.BASE_DIR, "conf/conf.ini")
+# seconds between two stat() of conf.ini
+CONF_CHECK_INTERVAL = 1
+
+
+class Datasource(Mapping):
+    """
+    Immutable connection params of one conf.ini section, pass it as
+    `tools.database(**dbinfo)` or `tools.database(dbinfo)`.
+
+    It is hashable and carries `key`, computed once, which tools.database
+    uses to find the DB object (and its connection pool) of the section.
+    """
+    __slots__ = ["section", "key", "_params"]
+
+    def __init__(self, section, params):
+        self.section = section
+        self._params = dict(params)
+        self.key = repr(sorted(self._params.items()))
+
+    def __getitem__(self, name):
+        return self._params[name]
+
+    def __iter__(self):
+        return iter(self._params)
+
+    def __len__(self):
+        return len(self._params)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, Datasource) and other.key == self.key
+
+    def __repr__(self):
+        return '<Datasource [%s] %s>' % (self.section, self.get('dbn'))
+
+
+_conf = None
+_conf_lock = threading.Lock()
+
+
+def _loadDBConf():
+    """parses conf.ini and validates every section, returns {section: (state, dbinfo)}"""
     conf = configparser.ConfigParser()
-    conf.read(os.path.join(settings.BASE_DIR, "conf/conf.ini"))
+    conf.read(CONF_FILE)
+    sections = {}
+    for section in conf.sections():
+        try:
+            sections[section] = _parseDBConf(conf, section)
+        except ValueError as e:
+            sections[section] = False, "[%s] %s" % (section, str(e))
+        if not sections[section][0] and conf.has_option(section, "DBN"):
+            print("conf.ini [%s]: %s(%s)" % (section, sections[section][1], os.getpid()))
+    return sections
+
+
+def _confMtime():
+    try:
+        return os.stat(CONF_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def getDBConf(type):
+    """
+    Returns (True, Datasource) for the conf.ini section `type`, or
+    (False, error message). conf.ini is parsed once per process and again
+    only when its mtime changes, checked at most every CONF_CHECK_INTERVAL s.
+    """
+    global _conf
+    conf = _conf
+    now = time.time()
+    if conf is None or now - conf.checked > CONF_CHECK_INTERVAL:
+        with _conf_lock:
+            conf = _conf
+            if conf is None or now - conf.checked > CONF_CHECK_INTERVAL:
+                mtime = _confMtime()
+                if conf is None or mtime != conf.mtime:
+                    old, conf = conf, storage(mtime=mtime, sections=_loadDBConf())
+                    if old is not None:
+                        _retireDatasources(old.sections, conf.sections)
+                conf.checked = now
+                _conf = conf
+
+    if type not in conf.sections:
+        return False, "[%s] not exests in conf.ini" % str(type)
+    return conf.sections[type]
+
+
+def _retireDatasources(old, new):
+    """closes the pools of the datasources an edit of conf.ini replaced or removed"""
+    keys = set(dbinfo.key for state, dbinfo in new.values() if state)
+    for section, (state, dbinfo) in old.items():
+        if state and dbinfo.key not in keys:
+            print("conf.ini [%s] changed, closing the pool of its old datasource(%s)" % (section, os.getpid()))
+            tools.db.retire(dbinfo.key)
+
+
+def _parseDBConf(conf, type):
     dbinfo = {}
 
     if not conf.has_section(type):
@@ -145,10 +332,16 @@ def getDBConf(type):
     else:
         return False, "[PW] not exests in conf.ini"
 
+    # optional connection pool sizing, see tools.database
+    for option in ("POOL_MIN", "POOL_MAX", "POOL_TIMEOUT", "POOL_LIFETIME", "POOL_IDLE", "POOL_VALIDATE",
+                   "STATEMENT_CACHE"):
+        if conf.has_option(type, option):
+            dbinfo[option.lower()] = conf.get(type, option)
+
     if dbinfo['dbn'] == 'oracle':
         if conf.has_option(type, "SERVICE"):
             dbinfo['service'] = conf.get(type, "SERVICE")
         else:
             return False, "[SERVICE] not exests in conf.ini"
 
-    return True, dbinfo
+    return True, Datasource(type, dbinfo)
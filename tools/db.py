@@ -3,14 +3,17 @@ Database API
 (part of web.py)
 """
 from __future__ import print_function
-from .utils import threadeddict, storage, iters, iterbetter
+from .utils import threadlocaldict, storage, iters, iterbetter, LRU, rowtype
 import time, re
-from AccuradSite import settings
-import base64
+import collections
+import copy
+import operator
 import os
+import threading
 os.environ['NLS_LANG'] = 'SIMPLIFIED CHINESE_CHINA.UTF8'
 
 from .utils import string_types, numeric_types, iteritems
+from . import green, metrics
 import tools
 
 try:
@@ -30,10 +33,11 @@ debug = sys.stderr
 config = storage()
 
 __all__ = [
-  "UnknownParamstyle", "UnknownDB", "TransactionError", 
+  "UnknownParamstyle", "UnknownDB", "TransactionError", "PoolTimeout", "UnitOfWorkError",
   "sqllist", "sqlors", "reparam", "sqlquote",
   "SQLQuery", "SQLParam", "sqlparam",
   "SQLLiteral", "sqlliteral",
+  "ConnectionPool", "Session", "UnitOfWork",
   "database", 'DB',
 ]
 
@@ -61,6 +65,25 @@ class _ItplError(ValueError):
 class TransactionError(Exception): pass
 
 
+class UnitOfWorkError(Exception):
+    """
+    raised when a unit of work ends after one of its statements failed and
+    the rollback that followed dropped the statements deferred before it:
+    `query` is the failed statement, `lost` how many were rolled back with
+    it, the driver error is the __cause__
+    """
+    def __init__(self, query, lost, error):
+        Exception.__init__(self, "unit of work rolled back: %d deferred statement(s) lost when [%s] failed: %s"
+                           % (lost, query, error))
+        self.query = query
+        self.lost = lost
+
+
+class PoolTimeout(Exception):
+    """raised when no pooled connection frees up within the checkout timeout"""
+    pass
+
+
 class UnknownParamstyle(Exception): 
     """
     raised for unsupported db paramstyles
@@ -473,8 +496,629 @@ class Transaction:
             self.ctx.transactions = self.ctx.transactions[:self.transaction_count]
 
 
+def _storage(ctx):
+    """the mapping holding the values of `ctx` for the current thread: its
+    dict for this thread when `ctx` is a ThreadLocalDict, the Storage of a
+    bound DB itself (see DB.bind)"""
+    return ctx if isinstance(ctx, dict) else ctx.__dict__
+
+
+class Session:
+    """
+    Scoped session, pins one connection to the current thread.
+
+    Outside a session every statement checks a connection out of the pool and
+    gives it back on commit. Inside one the statements share the same
+    connection, autocommit and transactions behave as usual, and the
+    connection goes back to the pool when the outermost session exits:
+
+        with db.session():
+            db.insert('test', a=1)
+            db.callproc('proc', [], parmout)  # out cursors stay readable here
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        ctx = self.db._ctx
+        ctx.pinned = ctx.get('pinned', 0) + 1
+        # the storage of this thread: a stream may be closed, and its session exited, on another one
+        self.ctx, self.scope = _storage(ctx), _storage(_scope)
+        return self.db
+
+    def __exit__(self, exctype, excvalue, traceback):
+        ctx = self.ctx
+        if not ctx.get('pinned'):
+            return  # context dropped by a fork inside the block
+        ctx['pinned'] -= 1
+        # a transaction or unit of work still open gives the connection back when it ends
+        if ctx['pinned'] or not ctx.get('db') or ctx.get('transactions'):
+            return
+        unit = ctx.get('unit') or self.scope.get('unit')
+        if unit is not None:
+            # e.g. a stream read inside the unit: nothing deferred its commit yet
+            unit.defer(self.db, ctx, 0)
+            return
+        if exctype is not None:
+            ctx['rollback']()
+        else:
+            ctx['commit']()
+
+
+class UnitOfWork:
+    """
+    Defers the commit every statement outside a transaction makes to a
+    single commit when the unit ends, or a rollback when it raises.
+
+    `UnitOfWork(db)` (or `db.unit_of_work()`) covers one DB object,
+    `UnitOfWork()` every DB used by the current thread in the block, which is
+    how the dispatcher runs endpoints declaring `UNIT_OF_WORK = True`:
+
+        with db.unit_of_work():
+            db.insert('test', a=1)
+            db.update('test', where='a=1', b=2)   # one commit, at the end
+
+    Units nest, an inner one leaves the commit to the outermost.
+
+    A failing statement rolls its connection back, and with it the statements
+    deferred before it. Its error is raised as usual; if the block goes on
+    anyway, the unit rolls back the rest as well when it ends and raises
+    UnitOfWorkError, naming the failed statement and how many were lost.
+    """
+    def __init__(self, db=None):
+        self.db = db
+        self.pending = {}  # id(context storage) -> [db, storage, deferred commits]
+        self.failure = None  # (query, deferred statements lost, error), see `fail`
+
+    def _holder(self):
+        return _scope if self.db is None else self.db._ctx
+
+    def __enter__(self):
+        holder = self._holder()
+        self.outer = holder.get('unit')
+        holder.unit = self
+        return self
+
+    def defer(self, db, ctx, commits=1):
+        """called by DB._autocommit instead of committing, by Session with
+        no `commits` to have its connection given back when the unit ends"""
+        ctx = _storage(ctx)
+        entry = self.pending.get(id(ctx))
+        if entry is None:
+            entry = self.pending[id(ctx)] = [db, ctx, 0]
+        entry[2] += commits
+
+    def fail(self, ctx, query, error):
+        """called by DB._db_execute when a statement of `ctx` fails, before
+        the rollback that drops what `ctx` deferred to this unit and the
+        units around it"""
+        unit = self
+        while unit is not None:
+            entry = unit.pending.pop(id(_storage(ctx)), None)
+            if entry is not None and entry[2] and unit.failure is None:
+                unit.failure = (query, entry[2], error)
+            unit = unit.outer
+
+    def __exit__(self, exctype, excvalue, traceback):
+        self._holder().unit = self.outer
+        if self.outer is not None:
+            for key, entry in self.pending.items():
+                if key in self.outer.pending:
+                    self.outer.pending[key][2] += entry[2]
+                else:
+                    self.outer.pending[key] = entry
+            return
+        self.end(exctype is None)
+
+    def end(self, commit=True):
+        """commits (or rolls back) the deferred work of every DB in the unit"""
+        pending, self.pending = self.pending, {}
+        failure, self.failure = self.failure, None
+        error = None
+        if failure is not None and commit:
+            # part of the unit is gone already, commit none of it
+            commit = False
+            error = UnitOfWorkError(*failure)
+            error.__cause__ = failure[2]
+        for db, ctx, deferred in pending.values():
+            # a failed statement already rolled back and gave the connection back
+            if not ctx.get('db') or ctx.get('transactions'):
+                continue
+            try:
+                if commit and error is None:
+                    ctx['commit']()
+                    _unit_stats.commits_avoided += max(deferred - 1, 0)
+                else:
+                    ctx['rollback']()
+            except Exception as e:
+                error = error or e
+                db.closedb()
+        _unit_stats.units += 1
+        if error is not None:
+            raise error
+
+
+class _Unpreparable(Exception):
+    """raised while preparing a statement whose shape depends on the values"""
+    pass
+
+
+class _Slot(object):
+    """
+    Stands for `vars[name]`, followed by the `.attr` / `[key]` lookups in
+    `path`, while a statement is prepared; `bind` resolves it for one execution.
+    """
+    __slots__ = ["name", "path"]
+
+    def __init__(self, name, path=()):
+        self.name = name
+        self.path = path
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return _Slot(self.name, self.path + ((getattr, attr),))
+
+    def __getitem__(self, key):
+        if isinstance(key, _Slot):
+            raise _Unpreparable(self.name)
+        return _Slot(self.name, self.path + ((operator.getitem, key),))
+
+    def bind(self, vars):
+        value = vars[self.name]
+        for get, key in self.path:
+            value = get(value, key)
+        return value
+
+    def __repr__(self):
+        return '$' + self.name
+
+
+class _Slots(object):
+    """the vars a statement is prepared with"""
+    def __getitem__(self, name):
+        return _Slot(name)
+
+
+class _Statement(object):
+    """A prepared SQLQuery: its text per paramstyle and its parameters in order."""
+    __slots__ = ["sql_query", "params", "texts"]
+
+    def __init__(self, sql_query):
+        self.sql_query = sql_query
+        self.params = sql_query.values()
+        self.texts = {}
+
+    def query(self, paramstyle=None):
+        text = self.texts.get(paramstyle)
+        if text is None:
+            text = self.texts[paramstyle] = self.sql_query.query(paramstyle)
+        return text
+
+    def bind(self, vars):
+        """Returns the statement with the values of one execution, None when
+        a value changes the statement itself (a list or an SQLLiteral)."""
+        values = []
+        for value in self.params:
+            if isinstance(value, _Slot):
+                value = value.bind(vars)
+            if isinstance(value, (list, SQLLiteral, SQLQuery)):
+                return None
+            values.append(value)
+        return _BoundQuery(self, values)
+
+
+class _BoundQuery(object):
+    """A prepared statement and its values, runs wherever an SQLQuery does."""
+    __slots__ = ["statement", "params"]
+
+    def __init__(self, statement, params):
+        self.statement = statement
+        self.params = params
+
+    def query(self, paramstyle=None):
+        return self.statement.query(paramstyle)
+
+    def values(self):
+        return list(self.params)
+
+    def __repr__(self):
+        return '<prepared: %r %r>' % (self.query(), self.params)
+
+
+class PreparedQuery(object):
+    """
+    A select, insert or update built once by `DB.prepare_select`,
+    `prepare_insert` or `prepare_update`.
+
+    `execute(vars)` only binds the values of `vars` to the parameters of the
+    statement, the SQL text is generated once per paramstyle. A call whose
+    values would change the SQL (a list expanding to `(a, b, ...)`, an
+    SQLLiteral) goes through the regular method instead.
+    """
+    def __init__(self, compiled, run, fallback):
+        self.multiple, self.statements = compiled
+        self.run = run
+        self.fallback = fallback
+
+    @staticmethod
+    def compile(build):
+        """Returns (multiple, statements) for the query `build(vars)` returns,
+        statements is None when it can't be prepared."""
+        try:
+            statement = build(_Slots())
+        except _Unpreparable:
+            return False, None
+        if isinstance(statement, tuple):
+            return True, [_Statement(SQLQuery(q)) for q in statement]
+        return False, [_Statement(SQLQuery(statement))]
+
+    def execute(self, vars=None, **kw):
+        if kw:
+            vars = dict(vars or {}, **kw)
+        elif vars is None:
+            vars = {}
+        if self.statements is not None:
+            bound = [statement.bind(vars) for statement in self.statements]
+            if None not in bound:
+                return self.run(tuple(bound) if self.multiple else bound[0])
+        return self.fallback(vars)
+
+    __call__ = execute
+
+
+class StatementCache(object):
+    """
+    Statements kept open on one connection, keyed by their final SQL text.
+
+    `get(query, open)` returns the cursor (or driver statement handle) that
+    already ran `query` on the connection, so the driver can execute it again
+    without parsing it, and opens it with `open()` on a miss. Past `maxsize`
+    the least recently used one is closed with `close`. A connection is used
+    by one thread at a time, so is its cache.
+    """
+    def __init__(self, maxsize, close=None):
+        self.maxsize = maxsize
+        self._close = close or (lambda cur: cur.close())
+        self._open = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, query, open):
+        cur = self._open.get(query)
+        if cur is not None:
+            self._open.move_to_end(query)
+            self.hits += 1
+            return cur
+        self.misses += 1
+        cur = self._open[query] = open()
+        while len(self._open) > self.maxsize:
+            self.evictions += 1
+            self._discard(self._open.popitem(last=False)[1])
+        return cur
+
+    def discard(self, query):
+        """closes the statement of `query`, e.g. after it failed"""
+        cur = self._open.pop(query, None)
+        if cur is not None:
+            self._discard(cur)
+
+    def _discard(self, cur):
+        try:
+            self._close(cur)
+        except Exception:
+            pass
+
+    def clear(self):
+        """closes every statement, before the connection itself is closed"""
+        open, self._open = self._open, collections.OrderedDict()
+        for cur in open.values():
+            self._discard(cur)
+
+    def __len__(self):
+        return len(self._open)
+
+
+class _PoolEntry(object):
+    """A connection owned by a ConnectionPool."""
+    __slots__ = ["conn", "pool", "created", "last_used", "pid", "statements", "broken"]
+
+    def __init__(self, conn, statements=None, pool=None):
+        self.conn = conn
+        self.pool = pool  # where it goes back, also once its datasource was retired
+        self.created = self.last_used = time.time()
+        self.pid = os.getpid()
+        self.statements = statements
+        self.broken = False  # set when the driver failed on it, `put` closes it
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of DB-API connections for one datasource.
+
+    `creator` opens a new connection, `ping` raises when a connection is dead,
+    `reset` restores the session state of a connection given back and
+    `close` closes one. The first `get` opens `minsize` connections up front
+    (see `fill`). Connections are handed out most recently used first;
+    one that lived longer than `lifetime` seconds is closed when given back,
+    idle ones above `minsize` are closed after `idle` seconds, and a
+    connection idle for more than `validate` seconds is pinged on checkout.
+    `get` waits at most `timeout` seconds once `maxsize` connections are out.
+    `cache`, when given, makes the StatementCache of a new connection.
+
+    A pool remembers the pid it was created in, used in a forked child it
+    starts over empty (see `after_fork`).
+    """
+    def __init__(self, creator, minsize=0, maxsize=10, timeout=30, lifetime=3600, idle=600,
+                 validate=1, ping=None, reset=None, close=None, cache=None, label=None):
+        self.creator = creator
+        self.minsize = minsize
+        self.maxsize = max(maxsize, 1)
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.idle = idle
+        self.validate = validate
+        self.ping = ping
+        self.reset = reset
+        self._close = close or (lambda conn: conn.close())
+        self.cache = cache
+        self.label = label
+        self.closed = False
+
+        self._reinit()
+
+    def _reinit(self):
+        self.pid = os.getpid()
+        self._idle = collections.deque()
+        self._entries = set()  # every connection of the pool, idle or checked out
+        self._size = 0
+        self._cond = threading.Condition(threading.Lock())
+        self.counters = storage(created=0, closed=0, checkouts=0, waits=0, timeouts=0, invalid=0)
+        self._retired = storage(hits=0, misses=0, evictions=0)  # statement caches of closed connections
+
+    def after_fork(self):
+        """Forgets the connections inherited from the parent process.
+
+        They are not closed: a close would log out the session the parent
+        still uses over the same socket. They stay referenced in `_inherited`
+        so that no driver finalizer closes them either.
+        """
+        if self.pid == os.getpid():
+            return
+        _inherited.extend(self._idle)
+        self._reinit()
+
+    def _expired(self, entry, now):
+        return self.lifetime and now - entry.created > self.lifetime
+
+    def _evict_idle(self, now):
+        """pops idle connections past `idle` seconds, call with the lock held"""
+        evicted = []
+        while self._idle and self._size > self.minsize and self.idle \
+                and now - self._idle[0].last_used > self.idle:
+            evicted.append(self._idle.popleft())
+            self._size -= 1
+        return evicted
+
+    def _close_all(self, entries):
+        for entry in entries:
+            statements = entry.statements
+            with self._cond:
+                self.counters.closed += 1
+                if statements is not None:
+                    self._entries.discard(entry)
+                    self._retired.hits += statements.hits
+                    self._retired.misses += statements.misses
+                    self._retired.evictions += statements.evictions
+            if statements is not None:
+                statements.clear()
+            try:
+                self._close(entry.conn)
+            except Exception:
+                pass
+
+    def _open(self):
+        """a new entry, its slot in `_size` already taken"""
+        entry = _PoolEntry(self.creator(), self.cache and self.cache(), self)
+        with self._cond:
+            self.counters.created += 1
+            if entry.statements is not None:
+                self._entries.add(entry)
+        return entry
+
+    def fill(self):
+        """Opens idle connections until the pool holds `minsize`."""
+        while True:
+            with self._cond:
+                if self._size >= self.minsize:
+                    return
+                self._size += 1
+            try:
+                entry = self._open()
+            except:
+                self._release_slot()
+                raise
+            with self._cond:
+                # the least recently used end, so idle eviction sees it first
+                self._idle.appendleft(entry)
+                self._cond.notify()
+
+    def get(self):
+        """Checks out a connection, returns its pool entry."""
+        if self.pid != os.getpid():
+            self.after_fork()
+        if self._size < self.minsize:
+            self.fill()
+        deadline = time.time() + self.timeout
+        while True:
+            entry = None
+            with self._cond:
+                while True:
+                    now = time.time()
+                    stale = self._evict_idle(now)
+                    if self._idle:
+                        entry = self._idle.pop()
+                        break
+                    if self._size < self.maxsize:
+                        self._size += 1
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.counters.timeouts += 1
+                        raise PoolTimeout("no connection available in %ss [%s]" % (self.timeout, self.label))
+                    self.counters.waits += 1
+                    self._cond.wait(remaining)
+                self.counters.checkouts += 1
+            self._close_all(stale)
+
+            if entry is None:
+                try:
+                    return self._open()
+                except:
+                    self._release_slot()
+                    raise
+
+            if self._expired(entry, now) or not self._check(entry, now):
+                self.discard(entry)
+                continue
+            return entry
+
+    def _check(self, entry, now):
+        if self.ping is None or now - entry.last_used <= self.validate:
+            return True
+        try:
+            self.ping(entry.conn)
+            return True
+        except Exception:
+            with self._cond:
+                self.counters.invalid += 1
+            return False
+
+    def put(self, entry):
+        """Gives back a connection checked out with `get`."""
+        if self._foreign(entry):
+            return
+        now = time.time()
+        if entry.broken or self.closed or self._expired(entry, now):
+            return self.discard(entry)
+        if self.reset is not None:
+            try:
+                self.reset(entry.conn)
+            except Exception:
+                return self.discard(entry)
+        entry.last_used = now
+        with self._cond:
+            self._idle.append(entry)
+            stale = self._evict_idle(now)
+            self._cond.notify()
+        self._close_all(stale)
+
+    def close(self):
+        """Closes the idle connections now and the ones checked out when
+        they are given back, see `retire`."""
+        with self._cond:
+            self.closed = True
+            idle, self._idle = list(self._idle), collections.deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        self._close_all(idle)
+
+    def discard(self, entry):
+        """Closes a checked out connection instead of giving it back."""
+        if self._foreign(entry):
+            return
+        self._close_all([entry])
+        self._release_slot()
+
+    def _foreign(self, entry):
+        """True for an entry checked out before a fork, the child must not touch it"""
+        if self.pid != os.getpid():
+            self.after_fork()
+        if entry.pid == self.pid:
+            return False
+        _inherited.append(entry)
+        return True
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            out = storage(self.counters)
+            out.size = self._size
+            out.idle = len(self._idle)
+            out.in_use = self._size - len(self._idle)
+            out.maxsize = self.maxsize
+            if self.cache is not None:
+                out.statements = self._statement_stats()
+        return out
+
+    def _statement_stats(self):
+        """statement cache counters of all connections, call with the lock held"""
+        out = storage(self._retired, open=0)
+        for entry in self._entries:
+            statements = entry.statements
+            out.hits += statements.hits
+            out.misses += statements.misses
+            out.evictions += statements.evictions
+            out.open += len(statements)
+        lookups = out.hits + out.misses
+        out.hit_rate = round(float(out.hits) / lookups, 3) if lookups else None
+        return out
+
+
+_pools = {}
+_contexts = {}
+_scope = threadlocaldict()  # thread wide unit of work, see UnitOfWork
+_unit_stats = storage(units=0, commits_avoided=0)
+_pools_lock = threading.Lock()
+_inherited = []  # connections of the parent process, kept alive but never used
+_pid = os.getpid()
+
+
+def after_fork():
+    """Drops the db state inherited from the parent process.
+
+    Runs in the child through os.register_at_fork; uwsgi forks its workers
+    from C, wsgi.py hooks it to uwsgi's postfork as well. Pools and contexts
+    also check the pid themselves, so a missed hook only delays the cleanup
+    to the first query. Calling it twice in the same process is harmless.
+    """
+    global _pid, _pools_lock
+    if _pid == os.getpid():
+        return
+    _pid = os.getpid()
+    _pools_lock = threading.Lock()
+    for ctx in list(_contexts.values()):
+        # only the forking thread survives, its contexts may hold a parent connection
+        held = ctx.get('pool_entry') or ctx.get('db')
+        if held is not None:
+            _inherited.append(held)
+        ctx.clear()
+    for pool in list(_pools.values()):
+        pool.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=after_fork)
+
+
+def _pool_stats():
+    return dict((pool.label, pool.stats()) for pool in list(_pools.values()) if not pool.closed)
+
+
+metrics.register('pools', _pool_stats)
+metrics.register('unit_of_work', lambda: storage(_unit_stats))
+
+
 class DB: 
     """Database"""
+    # cursors kept open per connection (see StatementCache), 0 for none
+    statement_cache = 0
+    # rows fetched per batch by query(..., stream=True)
+    stream_batch = 500
+
     def __init__(self, db_module, keywords, db_name):
         """Creates a database.
         """
@@ -485,62 +1129,84 @@ class DB:
         self.db_module = db_module
         self.keywords = keywords
         self.db_name = db_name
+        green.check_local()
+        green.check_driver(db_module)
 
-        settings.LOCK.acquire()
-        print("settings ctxs(%s): " % os.getpid(), settings.CTXS)
-        self.dbmark = self.caculateDBMark(keywords)
-        if settings.CTXS.keys().__contains__(self.dbmark) and settings.CTXS[self.dbmark].get('db'):
-            self._ctx = settings.CTXS[self.dbmark]
-        else:
-            self._ctx = threadeddict()
-            settings.CTXS[self.dbmark] = self._ctx
-        settings.LOCK.release()
+        # Pooling can be disabled by passing pooling=False in the keywords.
+        self.has_pooling = self.keywords.pop('pooling', True)
+        self.pool_options = dict(
+            minsize=int(self.keywords.pop('pool_min', 0)),
+            maxsize=int(self.keywords.pop('pool_max', 10)),
+            timeout=float(self.keywords.pop('pool_timeout', 30)),
+            lifetime=float(self.keywords.pop('pool_lifetime', 3600)),
+            idle=float(self.keywords.pop('pool_idle', 600)),
+            validate=float(self.keywords.pop('pool_validate', 1)))
+        self.statement_cache = int(self.keywords.pop('statement_cache', self.statement_cache))
+
+        self.dbmark = self.datasourceKey(keywords)
+        with _pools_lock:
+            self._ctx = _contexts.get(self.dbmark)
+            if self._ctx is None:
+                self._ctx = _contexts[self.dbmark] = threadlocaldict()
 
         # flag to enable/disable printing queries
         self.printing = config.get('debug_sql', config.get('debug', False))
         self.supports_multiple_insert = False
-        
-        try:
-            import DBUtils
-            # enable pooling if DBUtils module is available.
-            self.has_pooling = True
-        except ImportError:
-            self.has_pooling = False
-            
-        # Pooling can be disabled by passing pooling=False in the keywords.
-        self.has_pooling = self.keywords.pop('pooling', True) and self.has_pooling
-
-    def caculateDBMark(self, keywords):
-        mark = "accu_"
-        if keywords.keys().__contains__('host'):
-            mark = mark + keywords['host']
-        if keywords.keys().__contains__('port'):
-            mark = mark + str(keywords['port'])
-        if keywords.keys().__contains__('user'):
-            mark = mark + str(keywords['user'])
-        if keywords.keys().__contains__('password'):
-            mark = mark + str(keywords['password'])
-        if keywords.keys().__contains__('dsn'):
-            mark = mark + str(base64.b64encode(keywords['dsn'].encode('utf-8')), 'utf-8')
-
-        return str(base64.b64encode(mark.encode('utf-8')), 'utf-8')
-            
+        self._prepared = LRU(256)
+
+    def datasourceKey(self, keywords):
+        """key of the pool and thread contexts shared by every DB of the same datasource"""
+        return repr(sorted(keywords.items()))
+
+    def _label(self):
+        """datasource name shown in metrics, without credentials"""
+        kw = self.keywords
+        if kw.get('dsn'):
+            return '%s://%s' % (self.db_name, kw['dsn'])
+        host = kw.get('host') or kw.get('HOSTNAME') or ''
+        port = kw.get('port') or kw.get('PORT')
+        name = kw.get('db') or kw.get('database') or kw.get('DATABASE') or ''
+        return '%s://%s%s/%s' % (self.db_name, host, port and ':%s' % port or '', name)
+
     def _getctx(self):
+        if self._ctx.get('db') and self._ctx.pid != os.getpid():
+            after_fork()
         if not self._ctx.get('db'):
             self._load_context()
         return self._ctx
     ctx = property(_getctx)
 
+    def _getpool(self):
+        pool = _pools.get(self.dbmark)
+        if pool is None or pool.closed:
+            with _pools_lock:
+                pool = _pools.get(self.dbmark)
+                if pool is None or pool.closed:
+                    pool = _pools[self.dbmark] = ConnectionPool(
+                        lambda: self._connect(self.keywords),
+                        ping=self._ping, reset=self._reset, close=self._close,
+                        cache=self.statement_cache and self._statement_cache or None,
+                        label=self._label(), **self.pool_options)
+        return pool
+    pool = property(_getpool)
+
+    def _checkout(self):
+        """Binds a connection to the context of the current thread."""
+        self._ctx.pid = os.getpid()
+        if self.has_pooling:
+            entry = self.pool.get()
+            self._ctx.pool_entry = entry
+            self._ctx.statements = entry.statements
+            self._ctx.db = entry.conn
+        else:
+            self._ctx.db = self._connect(self.keywords)
+            self._ctx.statements = self.statement_cache and self._statement_cache() or None
+
     def _load_context(self):
         self._ctx.dbq_count = 0
         self._ctx.transactions = []  # stack of transactions
 
-        if self.has_pooling:
-            print('*-*' * 25, 'create new db pooling', '*-*' * 25)
-            self._ctx.db = self._connect_with_pooling(self.keywords)
-        else:
-            print('-*-' * 25, 'create new db connect:(%s)' % os.getpid(), '-*-' * 25)
-            self._ctx.db = self._connect(self.keywords)
+        self._checkout()
         self._ctx.db_execute = self._db_execute
         
         if not hasattr(self._ctx.db, 'commit'):
@@ -548,48 +1214,92 @@ class DB:
 
         if not hasattr(self._ctx.db, 'rollback'):
             self._ctx.db.rollback = lambda: None
-            
-        def commit(unload=False):
+
+        # the context of this thread, also when a stream is closed on another one
+        state = _storage(self._ctx)
+
+        def commit(unload=True):
             # do db commit and release the connection if pooling is enabled.            
-            self._ctx.db.commit()
-            if unload and self.has_pooling:
-                self._unload_context()
+            state['db'].commit()
+            if unload and self.has_pooling and not state.get('pinned'):
+                self._unload_context(state)
                 
         def rollback():
             # do db rollback and release the connection if pooling is enabled.
-            self._ctx.db.rollback()
-            if self.has_pooling:
-                self._unload_context()
+            state['db'].rollback()
+            if self.has_pooling and not state.get('pinned'):
+                self._unload_context(state)
 
         self._ctx.commit = commit
         self._ctx.rollback = rollback
             
-    def _unload_context(self):
-        del self._ctx.db
-            
+    def _unload_context(self, state=None):
+        """Gives the connection of the current thread (of the context
+        `state` when given) back to the pool."""
+        if state is None:
+            state = _storage(self._ctx)
+        entry = state.pop('pool_entry', None)
+        state.pop('statements', None)
+        state.pop('db', None)
+        if entry is not None:
+            entry.pool.put(entry)
+
+    def _discard_context(self):
+        """Drops the connection of the current thread, closing it."""
+        entry = self._ctx.pop('pool_entry', None)
+        statements = self._ctx.pop('statements', None)
+        conn = self._ctx.pop('db', None)
+        if entry is not None:
+            entry.pool.discard(entry)
+        elif conn is not None:
+            if statements is not None:
+                statements.clear()
+            self._close(conn)
+
     def _connect(self, keywords):
+        print('-*-' * 25, 'create new db connect:(%s)' % os.getpid(), '-*-' * 25)
         return self.db_module.connect(**keywords)
-        
-    def _connect_with_pooling(self, keywords):
-        def get_pooled_db():
-            from DBUtils import PooledDB
 
-            # In DBUtils 0.9.3, `dbapi` argument is renamed as `creator`
-            # see Bug#122112
-            
-            if PooledDB.__version__.split('.') < '0.9.3'.split('.'):
-                return PooledDB.PooledDB(dbapi=self.db_module, **keywords)
-            else:
-                return PooledDB.PooledDB(creator=self.db_module, **keywords)
-        
-        if getattr(self, '_pooleddb', None) is None:
-            self._pooleddb = get_pooled_db()
-        
-        return self._pooleddb.connection()
-        
+    def _ping(self, conn):
+        """raises if `conn` is no longer usable"""
+        if hasattr(conn, 'ping'):
+            conn.ping()
+        else:
+            cur = conn.cursor()
+            cur.execute(self._validation_query())
+            cur.fetchall()
+            cur.close()
+
+    def _validation_query(self):
+        return "SELECT 1"
+
+    def _reset(self, conn):
+        """ends whatever transaction a connection given back to the pool left open"""
+        conn.rollback()
+
+    def _close(self, conn):
+        conn.close()
+
     def _db_cursor(self):
         return self.ctx.db.cursor()
 
+    def _statement_cache(self):
+        """a new StatementCache for one connection"""
+        return StatementCache(self.statement_cache)
+
+    def _statement_cursor(self):
+        """opens the cursor a statement is cached with"""
+        return self._db_cursor()
+
+    def _statement(self, query, params):
+        """Returns the cursor to run `query` on: the one cached for it on the
+        connection, a new one when the connection keeps no statement cache.
+        Statements without parameters are one-off SQL and not cached."""
+        statements = self.ctx.get('statements')
+        if statements is None or not params:
+            return self._db_cursor()
+        return statements.get(query, self._statement_cursor)
+
     def _param_marker(self):
         """Returns parameter marker based on paramstyle attribute if this database."""
         style = getattr(self, 'paramstyle', 'pyformat')
@@ -603,17 +1313,33 @@ class DB:
         raise UnknownParamstyle(style)
 
     def _db_execute(self, cur, sql_query): 
-        """executes an sql query"""
+        """executes an sql query on `cur`, or when `cur` is None on the
+        cursor `_statement` picks, which is returned"""
         self.ctx.dbq_count += 1
-        
+        statements = self.ctx.get('statements')
+        query = None
+
         try:
             a = time.time()
             query, params = self._process_query(sql_query)
-            out = cur.execute(query, params)
+            if cur is None:
+                cur = out = self._statement(query, params)
+                cur.execute(query, params)
+            else:
+                out = cur.execute(query, params)
             b = time.time()
         except:
+            if statements is not None:
+                statements.discard(query)
             if self.printing:
                 print('ERR:', str(query), file=debug)
+            unit = self._ctx.get('unit') or _scope.get('unit')
+            if unit is not None and not self._ctx.transactions:
+                unit.fail(self._ctx, query, sys.exc_info()[1])
+            # the driver failed on the connection, it may be broken: the pool closes it once given back
+            entry = self._ctx.get('pool_entry') if query is not None else None
+            if entry is not None:
+                entry.broken = True
             try:
                 if self.ctx.transactions:
                     self.ctx.transactions[-1].rollback()
@@ -625,10 +1351,9 @@ class DB:
                 except:
                     raise
                 raise
-            try:
+            if entry is not None and self._ctx.get('pool_entry') is entry and not self._ctx.transactions:
+                # still pinned by a session: the next statement checks out a fresh one
                 self.closedb()
-            except:
-                raise
             raise
 
         if self.printing:
@@ -667,11 +1392,13 @@ class DB:
         else:
             return None
     
-    def query(self, sql_query, vars=None, processed=False, _test=False): 
+    def query(self, sql_query, vars=None, processed=False, _test=False, stream=False): 
         """
         Execute SQL query `sql_query` using dictionary `vars` to interpolate it.
         If `processed=True`, `vars` is a `reparam`-style list to use 
         instead of interpolating.
+        With `stream=True` (or a number of rows per batch) a select returns a
+        generator fetching the rows batch by batch, see `_query_stream`.
         
             >>> db = DB(None, {})
             >>> db.query("SELECT * FROM foo", _test=True)
@@ -688,35 +1415,36 @@ class DB:
         
         if _test: return sql_query
 
-        db_cursor = self._db_cursor()
+        if stream:
+            return self._query_stream(sql_query, self.stream_batch if stream is True else int(stream))
+
         try:
-            self._db_execute(db_cursor, sql_query)
+            db_cursor = self._db_execute(None, sql_query)
         except:
             raise
 
         if db_cursor.description:
-            names = [x[0] for x in db_cursor.description]
+            Row = rowtype([x[0] for x in db_cursor.description])
 
             def iterwrapper(results):
                 if results is None:
                     return
                 for row in results:
-                    yield storage(dict(zip(names, row)))
-            out = iterbetter(iterwrapper(db_cursor.fetchall()))
-            out.__len__ = lambda: int(db_cursor.rowcount)
-            out.list = lambda: [storage(dict(zip(names, x))) \
-                               for x in db_cursor.fetchall()]
+                    yield Row(row)
+            # fetch before the commit below hands the connection back to the pool
+            rows = db_cursor.fetchall()
+            rowcount = int(db_cursor.rowcount)
+            out = iterbetter(iterwrapper(rows))
+            out.__len__ = lambda: rowcount
+            out.list = lambda: [Row(x) for x in rows]
         else:
             out = db_cursor.rowcount
 
-        if not self.ctx.transactions:
-            self.ctx.commit()
-        if isinstance(out, int) and out < 0:
-            self.closedb()
+        self._autocommit()
         return out
     
     def select(self, tables, vars=None, what='*', where=None, order=None, group=None, 
-               limit=None, offset=None, _test=False): 
+               limit=None, offset=None, _test=False, stream=False): 
         """
         Selects `what` from `tables` with clauses `where`, `order`, 
         `group`, `limit`, and `offset`. Uses vars to interpolate. 
@@ -736,10 +1464,77 @@ class DB:
         qout = SQLQuery.join(clauses)
         if _test: return qout
         try:
-            out = self.query(qout, processed=True)
+            out = self.query(qout, processed=True, stream=stream)
         except:
             raise
         return out
+
+    def _query_stream(self, sql_query, batch):
+        """
+        Runs `sql_query` and returns a generator over its rows, fetched
+        `batch` rows at a time (on a server side cursor where the driver has
+        one). The connection stays checked out, as in a session, until the
+        generator is exhausted or closed; a statement that returns no rows
+        gives back its row count like `query`.
+
+        Don't run other statements on the same DB meanwhile: an unbuffered
+        MySQL cursor keeps the connection busy until its last row is read.
+        The rows may be read, and the generator closed, on another thread
+        (a streaming response): the connection released is still the one
+        of the thread that ran the query.
+        """
+        session = Session(self)
+        session.__enter__()
+        try:
+            out = self._stream_execute(sql_query, batch)
+        except:
+            session.__exit__(*sys.exc_info())
+            raise
+        if not isinstance(out, tuple):
+            session.__exit__(None, None, None)
+            return out
+        rows = self._stream(session, *out)
+        # run into the try block, closing or dropping the generator from here on releases the connection
+        next(rows)
+        return rows
+
+    def _stream_execute(self, sql_query, batch):
+        """executes a streamed query, returns (names, fetchmany, close) for
+        a select, the row count otherwise"""
+        cur = self._stream_cursor(batch)
+        self._db_execute(cur, sql_query)
+        if not cur.description:
+            out = cur.rowcount
+            cur.close()
+            return out
+        return [x[0] for x in cur.description], cur.fetchmany, cur.close
+
+    def _stream_cursor(self, batch):
+        """the cursor a streamed query runs on, never one of the statement cache"""
+        cur = self._db_cursor()
+        cur.arraysize = batch
+        return cur
+
+    def _stream(self, session, names, fetchmany, close):
+        exc_info = (None, None, None)
+        Row = rowtype(names)
+        try:
+            yield
+            while True:
+                rows = fetchmany()
+                if not rows:
+                    break
+                for row in rows:
+                    yield Row(row)
+        except Exception:
+            exc_info = sys.exc_info()
+            raise
+        finally:
+            try:
+                close()
+            except Exception:
+                pass
+            session.__exit__(*exc_info)
     
     def where(self, table, what='*', order=None, group=None, limit=None, 
               offset=None, _test=False, **kwargs):
@@ -823,23 +1618,27 @@ class DB:
 
         if _test: return sql_query
         
-        db_cursor = self._db_cursor()
+        return self._execute_insert(self._insert_statement(sql_query, tablename, seqname))
+
+    def _insert_statement(self, sql_query, tablename, seqname):
+        """Returns what `_execute_insert` runs for the INSERT `sql_query`."""
         if seqname is not False: 
             sql_query = self._process_insert_query(sql_query, tablename, seqname)
+        return sql_query
 
-
+    def _execute_insert(self, sql_query):
         if isinstance(sql_query, tuple):
             # for some databases, a separate query has to be made to find 
             # the id of the inserted row.
             q1, q2 = sql_query
             try:
-                self._db_execute(db_cursor, q1)
-                self._db_execute(db_cursor, q2)
+                self._db_execute(None, q1)
+                db_cursor = self._db_execute(None, q2)
             except:
                 raise
         else:
             try:
-                self._db_execute(db_cursor, sql_query)
+                db_cursor = self._db_execute(None, sql_query)
             except:
                 raise
 
@@ -848,12 +1647,7 @@ class DB:
         except Exception: 
             out = None
 
-        if not self.ctx.transactions: 
-            self.ctx.commit()
-
-        if isinstance(out, int) and out < 0:
-            self.closedb()
-
+        self._autocommit()
         return out
         
     def _get_insert_default_values_query(self, table):
@@ -912,7 +1706,6 @@ class DB:
             sql_query = sql_query + " select 1 from dual "
         if _test: return sql_query
 
-        db_cursor = self._db_cursor()
         if seqname is not False: 
             sql_query = self._process_insert_query(sql_query, tablename, seqname)
 
@@ -921,13 +1714,13 @@ class DB:
             # the id of the inserted row.
             q1, q2 = sql_query
             try:
-                self._db_execute(db_cursor, q1)
-                self._db_execute(db_cursor, q2)
+                self._db_execute(None, q1)
+                db_cursor = self._db_execute(None, q2)
             except:
                 raise
         else:
             try:
-                self._db_execute(db_cursor, sql_query)
+                db_cursor = self._db_execute(None, sql_query)
             except:
                 raise
 
@@ -937,11 +1730,8 @@ class DB:
         except Exception: 
             out = None
 
-        if not self.ctx.transactions: 
-            self.ctx.commit()
+        self._autocommit()
 
-        if isinstance(out, int) and out < 0:
-            self.closedb()
         return out
 
     def update(self, tables, where, vars=None, _test=False, **values): 
@@ -972,16 +1762,16 @@ class DB:
 
         if _test: return query
         
-        db_cursor = self._db_cursor()
+        return self._execute_update(query)
+
+    def _execute_update(self, query):
         try:
-            self._db_execute(db_cursor, query)
+            db_cursor = self._db_execute(None, query)
         except:
             raise
-        if not self.ctx.transactions: 
-            self.ctx.commit()
+        # read before the commit hands the connection, and its cursors, back to the pool
         out = db_cursor.rowcount
-        if out < 0:
-            self.closedb()
+        self._autocommit()
         return out
     
     def delete(self, table, where, using=None, vars=None, _test=False): 
@@ -1002,19 +1792,89 @@ class DB:
 
         if _test: return q
 
-        db_cursor = self._db_cursor()
         try:
-            self._db_execute(db_cursor, q)
+            db_cursor = self._db_execute(None, q)
         except:
             raise
-        if not self.ctx.transactions: 
-            self.ctx.commit()
-
         out = db_cursor.rowcount
-        if out < 0:
-            self.closedb()
+        self._autocommit()
         return out
 
+    def _prepare(self, key, build, run, fallback):
+        # the statements are shared by the copies of `bind`, run and fallback
+        # stay with the DB object asked
+        compiled = self._prepared.get(key)
+        if compiled is None:
+            compiled = self._prepared.put(key, PreparedQuery.compile(build))
+        return PreparedQuery(compiled, run, fallback)
+
+    def prepare_select(self, tables, what='*', where=None, order=None, group=None, limit=None, offset=None):
+        """
+        Prepares a select for repeated use, `$name`s in the clauses are
+        looked up in the vars given to each execution:
+
+            by_name = db.prepare_select('test', where='a = $a AND c > $c', order='d desc')
+            rows = by_name.execute(a='hehe', c=1)    # or by_name(dict(a='hehe', c=1))
+
+        Prepared statements are cached by their arguments, so preparing the
+        same select in every request returns the already built one.
+        """
+        def build(vars):
+            return self.select(tables, vars=vars, what=what, where=where, order=order,
+                               group=group, limit=limit, offset=offset, _test=True)
+
+        def run(query):
+            return self.query(query, processed=True)
+
+        def fallback(vars):
+            return self.select(tables, vars=vars, what=what, where=where, order=order,
+                               group=group, limit=limit, offset=offset)
+
+        key = repr(('select', tables, what, where, order, group, limit, offset))
+        return self._prepare(key, build, run, fallback)
+
+    def prepare_insert(self, tablename, columns, seqname=None):
+        """
+        Prepares an insert of `columns` into `tablename`, each execution
+        takes the column values from its vars, see `prepare_select`:
+
+            add = db.prepare_insert('test', ['a', 'b'])
+            add.execute(a='sigal', b='n')
+        """
+        def values(vars):
+            return dict((column, vars[column]) for column in columns)
+
+        def build(vars):
+            return self._insert_statement(self.insert(tablename, seqname=seqname, _test=True, **values(vars)),
+                                          tablename, seqname)
+
+        def fallback(vars):
+            return self.insert(tablename, seqname=seqname, **values(vars))
+
+        key = repr(('insert', tablename, sorted(columns), seqname))
+        return self._prepare(key, build, self._execute_insert, fallback)
+
+    def prepare_update(self, tables, where, columns):
+        """
+        Prepares an update setting `columns` of the rows matching `where`,
+        each execution takes the column values and the `$name`s of `where`
+        from its vars, see `prepare_select`:
+
+            rename = db.prepare_update('test', where='a = $old', columns=['a'])
+            rename.execute(old='fad', a='mn')
+        """
+        def values(vars):
+            return dict((column, vars[column]) for column in columns)
+
+        def build(vars):
+            return self.update(tables, where, vars=vars, _test=True, **values(vars))
+
+        def fallback(vars):
+            return self.update(tables, where, vars=vars, **values(vars))
+
+        key = repr(('update', tables, where, sorted(columns)))
+        return self._prepare(key, build, self._execute_update, fallback)
+
     def _process_insert_query(self, query, tablename, seqname):
         return query
 
@@ -1022,12 +1882,41 @@ class DB:
         """Start a transaction."""
         return Transaction(self.ctx)
 
+    def session(self):
+        """Pins a connection to the current thread for a with block, see `Session`."""
+        return Session(self)
+
+    def unit_of_work(self):
+        """Defers the autocommits of this DB in a with block to one commit, see `UnitOfWork`."""
+        return UnitOfWork(self)
+
+    def _autocommit(self):
+        """Commits after a statement run outside a transaction, or hands the
+        commit to the unit of work in progress."""
+        ctx = self.ctx
+        if ctx.transactions:
+            return
+        unit = ctx.get('unit') or _scope.get('unit')
+        if unit is not None:
+            unit.defer(self, ctx)
+        else:
+            ctx.commit()
+
+    def bind(self):
+        """Returns a copy of this DB with a context of its own instead of the
+        thread local one.
+
+        The copy shares the pool but keeps its connection and transactions
+        wherever it is used from, e.g. one request whose sync parts run in
+        executor threads under ASGI. It must not be used by two threads at once.
+        """
+        bound = copy.copy(self)
+        bound._ctx = storage()
+        return bound
+
     def closedb(self):
-        try:
-            settings.CTXS.pop(self.dbmark)
-            self._ctx.db.cursor().connection.close()
-        except:
-            raise
+        """Closes the connection of the current thread, the next query opens a fresh one."""
+        self._discard_context()
 
     def closecursor(self):
         self._db_cursor().close()
@@ -1064,7 +1953,7 @@ class PostgresDB(DB):
         
         self.dbname = "postgres"
         self.paramstyle = db_module.paramstyle
-        DB.__init__(self, db_module, keywords)
+        DB.__init__(self, db_module, keywords, self.dbname)
         self.supports_multiple_insert = True
         self._sequences = None
         
@@ -1095,11 +1984,6 @@ class PostgresDB(DB):
             # fallback for pgdb driver
             conn.cursor().execute("set client_encoding to 'UTF-8'")
         return conn
-        
-    def _connect_with_pooling(self, keywords):
-        conn = DB._connect_with_pooling(self, keywords)
-        conn._con._con.set_client_encoding('UTF8')
-        return conn
 
 
 class MySQLDB(DB): 
@@ -1128,6 +2012,35 @@ class MySQLDB(DB):
         self.dbname = "mysql"
         DB.__init__(self, db, keywords, self.dbname)
         self.supports_multiple_insert = True
+        if db.__name__ != "mysql.connector":
+            # MySQLdb and pymysql interpolate the values client side, the
+            # server never sees a statement that could be kept
+            self.statement_cache = 0
+        elif self.statement_cache:
+            # server side prepared statements take ? markers, and the SQL
+            # text is sent as is, without %% escapes
+            self.paramstyle = 'qmark'
+
+    def _statement_cursor(self):
+        return self.ctx.db.cursor(prepared=True)
+
+    def _stream_cursor(self, batch):
+        # unbuffered cursors read the rows from the socket as they are fetched
+        name = self.db_module.__name__
+        if name == "MySQLdb":
+            import MySQLdb.cursors
+            cur = self.ctx.db.cursor(MySQLdb.cursors.SSCursor)
+        elif name == "pymysql":
+            import pymysql.cursors
+            cur = self.ctx.db.cursor(pymysql.cursors.SSCursor)
+        elif self.paramstyle == 'qmark':
+            # with a statement cache the SQL carries ? markers only prepared
+            # cursors take, they too read the rows as they are fetched
+            cur = self.ctx.db.cursor(prepared=True)
+        else:
+            cur = self.ctx.db.cursor(buffered=False)
+        cur.arraysize = batch
+        return cur
 
     def callproc(self, name, parmin=[], parmout=[], has_return=False):
         len_parmin = len(parmin)
@@ -1186,8 +2099,7 @@ class MySQLDB(DB):
             self.closedb()
             return False
 
-        if not self.ctx.transactions:
-            self.ctx.commit()
+        self._autocommit()
         return True
 
     def get_parm(self, type):
@@ -1214,6 +2126,9 @@ class MySQLDB(DB):
 
 
 class DB2DB(DB):
+    # prepared statements kept per connection, executed again with new values
+    statement_cache = 20
+
     def __init__(self, **keywords):
 
         db = import_driver(["ibm_db"], preferred=keywords.pop('driver', None))
@@ -1239,12 +2154,14 @@ class DB2DB(DB):
         elif keywords['charset'] is None:
             del keywords['charset']
 
-        self.paramstyle = db.paramstyle = 'pyformat'  # it's both, like psycopg
+        # values are bound to ? markers by ibm_db.execute, never formatted into the SQL
+        self.paramstyle = db.paramstyle = 'qmark'
         self.dbname = "db2"
         DB.__init__(self, db, keywords, self.dbname)
         self.supports_multiple_insert = True
 
     def _connect(self, keywords):
+        print('-*-' * 25, 'create new db connect:(%s)' % os.getpid(), '-*-' * 25)
         conn = "DATABASE=%s;HOSTNAME=%s;PORT=%s;PROTOCOL=%s;UID=%s;PWD=%s;" % (keywords["DATABASE"], keywords["HOSTNAME"], keywords["PORT"], keywords["PROTOCOL"], keywords["UID"], keywords["PWD"])
         return self.db_module.connect(conn, "", "")
 
@@ -1252,56 +2169,85 @@ class DB2DB(DB):
         self._ctx.dbq_count = 0
         self._ctx.transactions = []  # stack of transactions
 
-        if self.has_pooling:
-            print('*-*' * 25, 'create new db pooling', '*-*' * 25)
-            self._ctx.db = self._connect_with_pooling(self.keywords)
-        else:
-            print('-*-' * 25, 'create new db connect:(%s)' % os.getpid(), '-*-' * 25)
-            self._ctx.db = self._connect(self.keywords)
+        self._checkout()
         self._ctx.db_execute = self._db_execute
+        state = _storage(self._ctx)
 
-        def commit(unload=False):
+        def commit(unload=True):
             # do db commit and release the connection if pooling is enabled.
-            self.db_module.commit(self._ctx.db)
-            if unload and self.has_pooling:
-                self._unload_context()
+            self.db_module.commit(state['db'])
+            if unload and self.has_pooling and not state.get('pinned'):
+                self._unload_context(state)
 
         def rollback():
             # do db rollback and release the connection if pooling is enabled.
-            self.db_module.rollback(self._ctx.db)
-            if self.has_pooling:
-                self._unload_context()
+            self.db_module.rollback(state['db'])
+            if self.has_pooling and not state.get('pinned'):
+                self._unload_context(state)
 
         self._ctx.commit = commit
         self._ctx.rollback = rollback
 
-    def _db_execute(self, sql_query):
-        """executes an sql query"""
+    def _statement_cache(self):
+        return StatementCache(self.statement_cache, self.db_module.free_stmt)
+
+    def _statement(self, query, params, cached=True):
+        """Returns the prepared statement of `query`, the one cached on the
+        connection when there is one."""
+        def prepare():
+            stmt = self.db_module.prepare(self.ctx.db, query)
+            if not stmt:
+                raise Exception(self.db_module.stmt_errormsg())
+            return stmt
+
+        statements = self.ctx.get('statements')
+        if statements is None or not params or not cached:
+            return prepare()
+        return statements.get(query, prepare)
+
+    def _db_execute(self, sql_query, stream=False):
+        """executes an sql query, returns (column names, row tuples) for a
+        select or the count of rows changed; with `stream` the statement
+        itself instead of the rows, on a statement of its own"""
         self.ctx.dbq_count += 1
+        statements = self.ctx.get('statements')
+        query = None
 
         try:
-            out = []
             a = time.time()
             query, params = self._process_query(sql_query)
 
-            for i in range(len(params)):
-                if isinstance(params[i], str):
-                    params[i] = "'%s'" % params[i]
-
-            # self.db_module.autocommit(self.ctx.db, self.db_module.SQL_AUTOCOMMIT_OFF)
-            stmt = self.db_module.exec_immediate(self.ctx.db, query % tuple(params))
-            if str(query).lstrip(" ").lower().startswith("select"):
-                results = self.db_module.fetch_both(stmt)
-                while results:
-                    out.append(results)
-                    results = self.db_module.fetch_both(stmt)
+            stmt = self._statement(query, params, cached=not stream)
+            self.db_module.execute(stmt, tuple(params))
+            # statements returning rows have a result set, whatever their first keyword
+            ncols = self.db_module.num_fields(stmt)
+            if ncols and stream:
+                out = [self.db_module.field_name(stmt, i) for i in range(ncols)], stmt
+            elif ncols:
+                names = [self.db_module.field_name(stmt, i) for i in range(ncols)]
+                rows = []
+                fetch = self.db_module.fetch_tuple
+                row = fetch(stmt)
+                while row:
+                    rows.append(row)
+                    row = fetch(stmt)
+                out = names, rows
             else:
                 out = self.db_module.num_rows(stmt)
 
             b = time.time()
         except:
+            if statements is not None:
+                statements.discard(query)
             if self.printing:
-                print('ERR:', str(query % tuple(params)), file=debug)
+                print('ERR:', str(query), file=debug)
+            unit = self._ctx.get('unit') or _scope.get('unit')
+            if unit is not None and not self._ctx.transactions:
+                unit.fail(self._ctx, query, sys.exc_info()[1])
+            # the driver failed on the connection, it may be broken: the pool closes it once given back
+            entry = self._ctx.get('pool_entry') if query is not None else None
+            if entry is not None:
+                entry.broken = True
             try:
                 if self.ctx.transactions:
                     self.ctx.transactions[-1].rollback()
@@ -1313,21 +2259,22 @@ class DB2DB(DB):
                 except:
                     raise
                 raise
-            try:
+            if entry is not None and self._ctx.get('pool_entry') is entry and not self._ctx.transactions:
+                # still pinned by a session: the next statement checks out a fresh one
                 self.closedb()
-            except:
-                raise
             raise
 
         if self.printing:
             print('%s (%s): %s' % (round(b - a, 2), self.ctx.dbq_count, str(query)), file=debug)
         return out
 
-    def query(self, sql_query, vars=None, processed=False, _test=False):
+    def query(self, sql_query, vars=None, processed=False, _test=False, stream=False):
         """
         Execute SQL query `sql_query` using dictionary `vars` to interpolate it.
         If `processed=True`, `vars` is a `reparam`-style list to use
         instead of interpolating.
+        With `stream=True` (or a number of rows per batch) a select returns a
+        generator fetching the rows batch by batch, see `DB._query_stream`.
 
             >>> db = DB(None, {})
             >>> db.query("SELECT * FROM foo", _test=True)
@@ -1344,43 +2291,50 @@ class DB2DB(DB):
 
         if _test: return sql_query
 
+        if stream:
+            return self._query_stream(sql_query, self.stream_batch if stream is True else int(stream))
+
         try:
             results = self._db_execute(sql_query)
         except:
             raise
         if isinstance(results, int):
             return results
-        if results is False or results == []:  # 查询结果为空
-            out = []
-        else:
-            names = []
-            datas = []
-            for i in range(len(results)):
-                data = []
-                if i == 0:
-                    for x in dict(results[0]).keys():
-                        if isinstance(x, str):
-                            names.append(x)
-                for x in dict(results[0]).keys():
-                    if isinstance(x, str):
-                        data.append(results[i][x])
-                datas.append(data)
 
-            def iterwrapper(results):
-                if results is None:
-                    return
-                for row in results:
-                    yield storage(dict(zip(names, row)))
+        names, rows = results
+        Row = rowtype(names)
 
-            out = iterbetter(iterwrapper(datas))
-            out.__len__ = lambda: int(len(datas))
-            out.list = lambda: [storage(dict(zip(names, x))) \
-                                for x in datas]
+        def iterwrapper(results):
+            if results is None:
+                return
+            for row in results:
+                yield Row(row)
 
-        if not self.ctx.transactions:
-            self.ctx.commit()
+        out = iterbetter(iterwrapper(rows))
+        out.__len__ = lambda: len(rows)
+        out.list = lambda: [Row(x) for x in rows]
+
+        self._autocommit()
         return out
 
+    def _stream_execute(self, sql_query, batch):
+        out = self._db_execute(sql_query, stream=True)
+        if not isinstance(out, tuple):
+            return out
+        names, stmt = out
+        fetch = self.db_module.fetch_tuple
+
+        def fetchmany():
+            rows = []
+            while len(rows) < batch:
+                row = fetch(stmt)
+                if not row:
+                    break
+                rows.append(row)
+            return rows
+
+        return names, fetchmany, lambda: self.db_module.free_stmt(stmt)
+
     def insert(self, tablename, seqname=None, _test=False, **values):
         """
         Inserts `values` into `tablename`. Returns current sequence ID.
@@ -1412,17 +2366,18 @@ class DB2DB(DB):
 
         if _test: return sql_query
 
+        return self._execute_insert(sql_query)
+
+    def _insert_statement(self, sql_query, tablename, seqname):
+        return sql_query
+
+    def _execute_insert(self, sql_query):
         try:
             out = self._db_execute(sql_query)
         except:
             raise
 
-        if not self.ctx.transactions:
-            self.ctx.commit()
-
-        if isinstance(out, int) and out < 0:
-            self.closedb()
-
+        self._autocommit()
         return out
 
     def multiple_insert(self, tablename, values, seqname=None, _test=False):
@@ -1476,12 +2431,7 @@ class DB2DB(DB):
         except:
             raise
 
-        if not self.ctx.transactions:
-            self.ctx.commit()
-
-        if isinstance(out, int) and out < 0:
-            self.closedb()
-
+        self._autocommit()
         return out
 
     def update(self, tables, where, vars=None, _test=False, **values):
@@ -1512,17 +2462,15 @@ class DB2DB(DB):
 
         if _test: return query
 
+        return self._execute_update(query)
+
+    def _execute_update(self, query):
         try:
             out = self._db_execute(query)
         except:
             raise
 
-        if not self.ctx.transactions:
-            self.ctx.commit()
-
-        if isinstance(out, int) and out < 0:
-            self.closedb()
-
+        self._autocommit()
         return out
 
     def delete(self, table, where, using=None, vars=None, _test=False):
@@ -1548,12 +2496,7 @@ class DB2DB(DB):
         except:
             raise
 
-        if not self.ctx.transactions:
-            self.ctx.commit()
-
-        if isinstance(out, int) and out < 0:
-            self.closedb()
-
+        self._autocommit()
         return out
 
     def callproc(self, name, parmin=[], parmout=[], has_return=False):
@@ -1605,8 +2548,7 @@ class DB2DB(DB):
             self.closedb()
             return False
 
-        if not self.ctx.transactions:
-            self.ctx.commit()
+        self._autocommit()
         return True
 
     def get_parm(self, type):
@@ -1625,13 +2567,15 @@ class DB2DB(DB):
         else:
             return ""
 
-    def closedb(self):
-        try:
-            settings.CTXS.pop(self.dbmark)
-            if self._ctx.db:
-                self.db_module.close(self._ctx.db)
-        except:
-            raise
+    def _ping(self, conn):
+        if not self.db_module.active(conn):
+            raise self.db_module.Error("connection is not active")
+
+    def _reset(self, conn):
+        self.db_module.rollback(conn)
+
+    def _close(self, conn):
+        self.db_module.close(conn)
 
     def _process_insert_query(self, query, tablename, seqname):
         return query, SQLQuery('SELECT last_insert_id();')
@@ -1639,6 +2583,18 @@ class DB2DB(DB):
     def _get_insert_default_values_query(self, table):
         return "INSERT INTO %s () VALUES()" % table
 
+    def sql_clauses(self, what, tables, where, group, order, limit, offset):
+        # DB2 takes no parameter marker in LIMIT / OFFSET, the values are
+        # checked to be numbers and written into the SQL
+        return (
+            ('SELECT', what),
+            ('FROM', sqllist(tables)),
+            ('WHERE', where),
+            ('GROUP BY', group),
+            ('ORDER BY', order),
+            ('LIMIT', limit and SQLQuery(str(int(limit)))),
+            ('OFFSET', offset and SQLQuery(str(int(offset)))))
+
 
 def import_driver(drivers, preferred=None):
     """Import the first available driver or preferred driver.
@@ -1664,12 +2620,15 @@ class SqliteDB(DB):
         # sqlite driver doesn't create datatime objects for timestamp columns unless `detect_types` option is passed.
         # It seems to be supported in sqlite3 and pysqlite2 drivers, not surte about sqlite.
         keywords.setdefault('detect_types', db.PARSE_DECLTYPES)
+        # sqlite3 keeps its own LRU of compiled statements per connection
+        if 'statement_cache' in keywords:
+            keywords['cached_statements'] = int(keywords.pop('statement_cache'))
 
         self.paramstyle = db.paramstyle
         keywords['database'] = keywords.pop('db')
         keywords['pooling'] = False # sqlite don't allows connections to be shared by threads
         self.dbname = "sqlite"        
-        DB.__init__(self, db, keywords)
+        DB.__init__(self, db, keywords, self.dbname)
 
     def _process_insert_query(self, query, tablename, seqname):
         return query, SQLQuery('SELECT last_insert_rowid();')
@@ -1695,8 +2654,9 @@ class FirebirdDB(DB):
         keywords['database'] = keywords.pop('db')
 
         self.paramstyle = db.paramstyle
+        self.dbname = "firebird"
 
-        DB.__init__(self, db, keywords)
+        DB.__init__(self, db, keywords, self.dbname)
         
     def delete(self, table, where=None, using=None, vars=None, _test=False):
         # firebird doesn't support using clause
@@ -1816,8 +2776,7 @@ class MSSQLDB(DB):
             self.closedb()
             return False
 
-        if not self.ctx.transactions:
-            self.ctx.commit()
+        self._autocommit()
         return True
 
     def get_parm(self, type):
@@ -1840,6 +2799,9 @@ class MSSQLDB(DB):
 
 
 class OracleDB(DB): 
+    # a cursor executing the same SQL again skips the parse altogether
+    statement_cache = 20
+
     def __init__(self, **keywords): 
         import cx_Oracle as db 
         if 'pw' in keywords: 
@@ -1853,11 +2815,26 @@ class OracleDB(DB):
         db.paramstyle = 'numeric' 
         self.paramstyle = db.paramstyle
 
-        # oracle doesn't support pooling 
-        # keywords.pop('pooling', None)
-        keywords['pooling'] = False
         DB.__init__(self, db, keywords, self.dbname)
 
+    def _connect(self, keywords):
+        conn = DB._connect(self, keywords)
+        # closed and evicted cursors land in the OCI statement cache, which
+        # saves the hard parse on the server
+        conn.stmtcachesize = max(conn.stmtcachesize, self.statement_cache)
+        return conn
+
+    def _stream_cursor(self, batch):
+        cur = self._db_cursor()
+        cur.arraysize = batch
+        # rows sent with the execute round trip, cx_Oracle 8+
+        if hasattr(cur, 'prefetchrows'):
+            cur.prefetchrows = batch + 1
+        return cur
+
+    def _validation_query(self):
+        return "SELECT 1 FROM dual"
+
     def _process_insert_query(self, query, tablename, seqname): 
         if seqname is None: 
             # It is not possible to get seq name from table name in Oracle
@@ -1917,8 +2894,7 @@ class OracleDB(DB):
             else:
                 parmout[i] = pp[i + len_parmin].getvalue()
 
-        if not self.ctx.transactions:
-            self.ctx.commit()
+        self._autocommit()
         return True
 
     def get_parm(self, type):
@@ -1966,25 +2942,55 @@ def dburl2dict(url):
 
 
 _databases = {}
+_instances = {}
 
 
 def database(dburl=None, **params):
     """Creates appropriate database using params.
     
-    Pooling will be enabled if DBUtils module is available. 
+    Connections come from a ConnectionPool shared by every DB object of the
+    same datasource, sized with the `pool_min`, `pool_max`, `pool_timeout`,
+    `pool_lifetime`, `pool_idle` and `pool_validate` params.
     Pooling can be disabled by passing pooling=False in params.
+
+    DB objects are built once per params, calling this again for the same
+    datasource returns a copy of the same object: it shares the pool, the
+    connection of the current thread and the prepared statements, while the
+    attributes a caller sets (`printing`, `supports_multiple_insert`) stay
+    on its copy. `dburl` may also be a tools.Datasource (see
+    tools.getDBConf), whose key is already computed.
     """
     if not dburl and not params:
         dburl = os.environ['DATABASE_URL']
-    if dburl:
-        params = dburl2dict(dburl)
-    # 取消pooling
-    params['pooling'] = False
-    dbn = params.pop('dbn')
-    if dbn in _databases:
-        return _databases[dbn](**params)
+    key = getattr(dburl, 'key', None)
+    if key is not None:
+        params = dict(dburl)
     else:
-        raise UnknownDB(dbn)
+        if dburl:
+            params = dburl2dict(dburl)
+        key = repr(sorted(params.items()))
+    db = _instances.get(key)
+    if db is None:
+        dbn = params.pop('dbn')
+        if dbn not in _databases:
+            raise UnknownDB(dbn)
+        db = _instances.setdefault(key, _databases[dbn](**params))
+    # scripts flip flags on the object they get, don't let them leak into other scripts
+    return copy.copy(db)
+
+
+def retire(key):
+    """
+    Closes the pool of the datasource `key` (the key of a tools.Datasource,
+    the same for the params it holds), e.g. once conf.ini no longer lists
+    it: idle connections are closed now, those in use when given back. A
+    later tools.database call with the same params opens a new pool.
+    """
+    with _pools_lock:
+        db = _instances.pop(key, None)
+        pool = _pools.get(db.dbmark) if db is not None else None
+    if pool is not None:
+        pool.close()
 
 
 def register_database(name, clazz):
@@ -2077,6 +3083,8 @@ def _interpolate(format):
 
 
 class _Node(object):
+    __slots__ = ["type", "first", "second"]
+
     def __init__(self, type, first, second=None):
         self.type = type
         self.first = first
@@ -2095,11 +3103,22 @@ class _Node(object):
 class Parser:
     """Parser to parse string templates like "Hello $name".
 
+    `$name` and `$name.attr.attr` (optionally inside `${...}`) are matched by
+    one compiled regex; literals and `[...]` subscripts go through the
+    token-by-token `parse_expr`.
+
     Loosely based on <http://lfw.org/python/Itpl.py> (public domain, Ka-Ping Yee)
     """
     namechars = "abcdefghijklmnopqrstuvwxyz" \
             "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_"
 
+    # next "$", with the plain forms matched right away: $name.attr... when
+    # not followed by something parse_expr would read further (another ".x",
+    # a "[" subscript, a quote as u'..' is a string token; \w stops the regex
+    # from backtracking into a name), and ${name.attr...}
+    names = r"[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*"
+    dollar = re.compile(r"\$(?:(%s)(?![.\['\"\w])|\{(%s)\})?" % (names, names))
+
     def __init__(self):
         self.reset()
 
@@ -2116,37 +3135,54 @@ class Parser:
         return self.parse_all()
 
     def parse_all(self):
+        text = self.text
+        search = self.dollar.search
         while True:
-            dollar = self.text.find("$", self.pos)
-            if dollar < 0:
+            match = search(text, self.pos)
+            if match is None:
                 break
-            nextchar = self.text[dollar + 1]
-            if nextchar in self.namechars:
-                yield _Node("text", self.text[self.pos:dollar])
-                self.pos = dollar+1
+            dollar = match.start()
+            name = match.group(1) or match.group(2)
+            if name:
+                yield _Node("text", text[self.pos:dollar])
+                self.pos = match.end()
+                yield self.simple_node(name)
+                continue
+
+            nextchar = text[dollar + 1:dollar + 2]
+            if nextchar and nextchar in self.namechars:
+                yield _Node("text", text[self.pos:dollar])
+                self.pos = dollar + 1
                 yield self.parse_expr()
 
             # for supporting ${x.id}, for backward compataility
             elif nextchar == '{':
                 saved_pos = self.pos
-                self.pos = dollar+2 # skip "${"
+                self.pos = dollar + 2  # skip "${"
                 expr = self.parse_expr()
-                if self.text[self.pos] == '}':
+                if text[self.pos:self.pos + 1] == '}':
                     self.pos += 1
-                    yield _Node("text", self.text[self.pos:dollar])
+                    yield _Node("text", text[saved_pos:dollar])
                     yield expr
                 else:
                     self.pos = saved_pos
                     break
             else:
-                yield _Node("text", self.text[self.pos:dollar+1])
+                yield _Node("text", text[self.pos:dollar + 1])
                 self.pos = dollar + 1
                 # $$ is used to escape $
                 if nextchar == "$":
                     self.pos += 1
 
-        if self.pos < len(self.text):
-            yield _Node("text", self.text[self.pos:])
+        if self.pos < len(text):
+            yield _Node("text", text[self.pos:])
+
+    def simple_node(self, name):
+        names = name.split(".")
+        expr = _Node("param", names[0])
+        for attr in names[1:]:
+            expr = _Node("getattr", expr, attr)
+        return expr
 
     def match(self):
         match = tokenprog.match(self.text, self.pos)
@@ -2186,11 +3222,19 @@ class Parser:
         return expr
 
 
+# parse trees of the reparam templates seen lately, a template is parsed once
+# and then only bound to the vars of each call
+_templates = LRU(1024)
+metrics.register('sql_templates', _templates.stats)
+
+
 class SafeEval(object):
     """Safe evaluator for binding params to db queries.
     """
     def safeeval(self, text, mapping):
-        nodes = Parser().parse(text)
+        nodes = _templates.get(text)
+        if nodes is None:
+            nodes = _templates.put(text, tuple(Parser().parse(text)))
         return SQLQuery.join([self.eval_node(node, mapping) for node in nodes], "")
 
     def eval_node(self, node, mapping):
@@ -2238,6 +3282,18 @@ def test_parser():
             _Node('literal', "'id'")),
         _Node("text", " LIMIT 1")])
 
+    f("WHERE id=${self.id} LIMIT 1", [
+        _Node("text", "WHERE id="),
+        _Node('getattr',
+            _Node('param', 'self', None),
+            'id'),
+        _Node("text", " LIMIT 1")])
+
+    f("price = $$5 AND id=$1", [
+        _Node("text", "price = $"),
+        _Node("text", "5 AND id="),
+        _Node("literal", "1")])
+
 
 def test_safeeval():
     def f(q, vars):
@@ -2247,8 +3303,28 @@ def test_safeeval():
     assert f("WHERE id=$id", {"id": 1}).items == ["WHERE id=", sqlparam(1)]
 
 
+def bench_parser(n=2000):
+    """
+    times cold parses of a long WHERE string, regex fast path vs token by token;
+    run from the project root with `python -m tools.db` (tools.db is part of a
+    package, `python tools/db.py` can't resolve its relative imports)
+    """
+    class TokenParser(Parser):
+        dollar = re.compile(r"\$()()")  # empty groups, every expression goes through parse_expr
+
+    text = " AND ".join("t%d.col_%d = $row.col_%d" % (i, i, i) for i in range(20)) + \
+        " AND name IN $names AND x = $o['k'] AND y = ${p.q}"
+    assert list(TokenParser().parse(text)) == list(Parser().parse(text))
+    for parser in (TokenParser, Parser):
+        a = time.time()
+        for i in range(n):
+            list(parser().parse(text))
+        print("%-12s %.1f us/parse" % (parser.__name__, (time.time() - a) * 1e6 / n))
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
     test_parser()
     test_safeeval()
+    bench_parser()
@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+"""
+one pass JSON encoder for api responses
+
+`envelope(code, desc, datas)` writes the {code, desc, datas} envelope of
+tools.response and everything in `datas` into one buffer, byte for byte what
+json.dumps would give. Query results go in as they come from tools.db (Row
+objects, lists of them, the iterbetter of `query`, the generator of a
+streamed query) without a dict per row: the `"name": ` fragments of a
+result set are encoded once per Row class.
+
+With `columnar` a result set (rows, or a list of dicts with the same keys
+as storage2Json returns) is written as {"columns": [...], "rows": [[...], ...]},
+naming each column once. The columns are the ones of the first row, a set
+of rows is expected to have one shape; an empty one stays [].
+
+Values json can't write go through the converter registered for their
+type (see `register_encoder`): Decimal as an exact number, datetime / date /
+time in ISO 8601, bytes in base64, cx_Oracle LOBs read when encoded.
+
+When orjson 3.9+ is installed (orjson.Fragment writes a Decimal exactly,
+older versions are left alone) `envelope` hands the tree to it instead, the
+output is then compact JSON (no blank after ',' and ':') and NaN / Infinity
+are written as null; what orjson refuses (ints beyond 64 bits) falls back to
+the encoder here. Datetimes, dataclasses and subclasses still go through
+their converters, a UUID too: orjson is skipped once another converter than
+str is registered for it. Set ORJSON to False to keep the stdlib output.
+
+`pack(media_type, code, desc, datas)` writes the same envelope as
+MessagePack or CBOR, when msgpack / cbor2 are installed (MEDIA_TYPES lists
+what can be served, `negotiate` picks one for an Accept header). bytes stay
+binary there; Decimal is an exact decimal in CBOR, a float in MessagePack.
+"""
+
+import base64
+import datetime
+import decimal
+import itertools
+import json
+import types
+import uuid
+import weakref
+from json.encoder import encode_basestring_ascii
+
+from .utils import Row, IterBetter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+__all__ = ["register_encoder", "Number", "json_default"]  # envelope / encode / pack stay tools.encoder.*
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+CBOR = 'application/cbor'
+MEDIA_TYPES = [JSON] + [MSGPACK] * (msgpack is not None) + [CBOR] * (cbor2 is not None)
+_aliases = {'application/x-msgpack': MSGPACK}
+
+ORJSON = orjson is not None and hasattr(orjson, 'Fragment')
+_fragments = weakref.WeakKeyDictionary()  # Row class -> [('"name": ', position)]
+
+
+class Number(str):
+    """the text of a JSON number, written as is (see the Decimal converter)"""
+    __slots__ = ()
+
+
+_encoders = {}  # type, or 'module.Name' for driver types not imported here -> converter
+_resolved = {}  # type -> converter or None, filled by _converter
+
+
+def register_encoder(type, convert):
+    """
+    Makes `convert(value)` the JSON form of the values of `type` (and its
+    subclasses): a str, number, list, dict, Number... or any value that has a
+    converter itself. `type` can be given as 'module.Name' for a class of a
+    driver that may not be installed, e.g. 'cx_Oracle.LOB'.
+    """
+    _encoders[type] = convert
+    _resolved.clear()
+
+
+def _converter(cls):
+    try:
+        return _resolved[cls]
+    except KeyError:
+        pass
+    convert = None
+    for base in cls.__mro__:
+        convert = _encoders.get(base) or _encoders.get('%s.%s' % (base.__module__, base.__name__))
+        if convert is not None:
+            break
+    _resolved[cls] = convert
+    return convert
+
+
+def _decimal(value):
+    if not value.is_finite():
+        return float(value)  # NaN / Infinity, as json writes them for floats
+    return Number(value)
+
+
+register_encoder(decimal.Decimal, _decimal)
+register_encoder(datetime.date, lambda value: value.isoformat())  # datetime included
+register_encoder(datetime.time, lambda value: value.isoformat())
+register_encoder(bytes, lambda value: base64.b64encode(value).decode('ascii'))
+register_encoder(bytearray, lambda value: base64.b64encode(value).decode('ascii'))
+register_encoder(memoryview, lambda value: base64.b64encode(value).decode('ascii'))
+register_encoder(uuid.UUID, str)
+register_encoder('cx_Oracle.LOB', lambda value: value.read())
+
+
+def _default(value):
+    # for the C encoder of json, which can't write a Number as is
+    convert = _converter(type(value))
+    if convert is None:
+        raise TypeError('Object of type %s is not JSON serializable' % type(value).__name__)
+    value = convert(value)
+    if isinstance(value, Number):
+        raise TypeError('Number')
+    return value
+
+
+_dumps = json.JSONEncoder(default=_default).encode
+
+
+def _float(value):
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return 'Infinity'
+    if value == -float('inf'):
+        return '-Infinity'
+    return float.__repr__(value)
+
+
+_scalars = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    float: _float,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+    Number: str.__str__,
+}
+
+_arrays = (list, tuple, IterBetter, types.GeneratorType)
+_missing = object()
+
+
+def _key(key):
+    """the '"key": ' fragment of a dict key, converted as json does"""
+    if isinstance(key, str):
+        pass
+    elif key is True:
+        key = 'true'
+    elif key is False:
+        key = 'false'
+    elif key is None:
+        key = 'null'
+    elif isinstance(key, float):
+        key = _float(key)
+    elif isinstance(key, int):
+        key = int.__repr__(key)
+    else:
+        raise TypeError('keys must be str, int, float, bool or None, not %s' % type(key).__name__)
+    return encode_basestring_ascii(key) + ': '
+
+
+def _encode(value, out, columnar=False):
+    scalar = _scalars.get(type(value))
+    if scalar is not None:
+        out.append(scalar(value))
+    elif isinstance(value, Row):
+        _row(value, out, columnar)
+    elif isinstance(value, dict):
+        _items(value.items(), '{', out, columnar)
+        out.append('}' if value else '{}')
+    elif isinstance(value, _arrays):
+        if columnar:
+            _columns(value, out)
+        else:
+            _array(value, out)
+    else:
+        convert = _converter(type(value))
+        if convert is not None:
+            _encode(convert(value), out, columnar)
+        else:
+            # str / int subclasses, and whatever json itself refuses
+            out.append(json.dumps(value))
+
+
+def _array(values, out, columnar=False):
+    sep = '['
+    for item in values:
+        out.append(sep)
+        _encode(item, out, columnar)
+        sep = ', '
+    out.append('[]' if sep == '[' else ']')
+
+
+def _items(items, sep, out, columnar=False):
+    for key, value in items:
+        out.append(sep)
+        out.append(_key(key))
+        _encode(value, out, columnar)
+        sep = ', '
+    return sep
+
+
+def _row(row, out, columnar=False):
+    cls = type(row)
+    keys = _fragments.get(cls)
+    if keys is None:
+        keys = _fragments[cls] = [(_key(name), i) for name, i in cls._index.items()]
+    values = row._values
+    sep = '{'
+    for key, i in keys:
+        out.append(sep)
+        out.append(key)
+        _encode(values[i], out, columnar)
+        sep = ', '
+    if row._extra:
+        sep = _items(row._extra.items(), sep, out, columnar)
+    out.append('{}' if sep == '{' else '}')
+
+
+def _columns_of(first, values):
+    """the columns of a result set starting with `first`, None for other arrays"""
+    if isinstance(first, Row):
+        if isinstance(values, (list, tuple)) and not all(isinstance(row, (Row, dict)) for row in values):
+            return None
+        return first.keys()
+    if isinstance(first, dict) and isinstance(values, list) \
+            and all(isinstance(row, dict) and row.keys() == first.keys() for row in values):
+        return list(first)
+    return None
+
+
+def _row_values(first, columns):
+    """returns a function giving the values of a row in the order of `columns`"""
+    plain = type(first) if isinstance(first, Row) and not first._extra else None
+    positions = plain and list(plain._index.values())
+    # rows straight from the driver need no reordering
+    whole = plain and positions == list(range(len(first._values)))
+
+    def row_values(row):
+        if type(row) is plain and not row._extra:
+            values = row._values
+            return values if whole else [values[i] for i in positions]
+        return [row.get(column) for column in columns]
+    return row_values
+
+
+def _columns(values, out):
+    """an array in columnar mode, the columnar layout when it holds a result set"""
+    rows = iter(values)
+    first = next(rows, _missing)
+    if first is _missing:
+        out.append('[]')
+        return
+    columns = _columns_of(first, values)
+    if columns is None:
+        return _array(itertools.chain([first], rows), out, True)
+
+    out.append('{"columns": ')
+    _array(columns, out)
+    out.append(', "rows": [')
+    row_values = _row_values(first, columns)
+    batch = []
+    sep = ''
+    for row in itertools.chain([first], rows):
+        batch.append(row_values(row))
+        if len(batch) == _BATCH:
+            sep = _rows(batch, out, sep)
+            batch = []
+    if batch:
+        _rows(batch, out, sep)
+    out.append(']}')
+
+
+_BATCH = 1000
+
+
+def _rows(batch, out, sep):
+    """writes a batch of value lists, through the C encoder of json when
+    they hold nothing but plain values"""
+    try:
+        text = _dumps(batch)
+    except TypeError:
+        text = []
+        _array(batch, text, True)
+        text = ''.join(text)
+    out.append(sep)
+    out.append(text[1:-1])
+    return ', '
+
+
+def encode(value, columnar=False):
+    """`value` as JSON text, the same as json.dumps(value) unless `columnar`"""
+    out = []
+    _encode(value, out, columnar)
+    return ''.join(out)
+
+
+_plain = ((str, str.__str__), (int, int.__int__), (float, float.__float__))
+
+
+def _default_of(value, listed, number):
+    """the form of `value` its packer can write, `number` makes a Number one"""
+    if isinstance(value, Row):
+        return value.todict()
+    if isinstance(value, (IterBetter, types.GeneratorType)):
+        # kept in case orjson fails and the stdlib encoder has to start over
+        rows = listed[id(value)] = list(value)
+        return rows
+    if isinstance(value, Number):
+        return number(value)
+    # subclasses orjson hands over, written as their base type like `encode` does
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    convert = _converter(type(value))
+    if convert is None:
+        for base, plain in _plain:
+            if isinstance(value, base):
+                return plain(value)
+        raise TypeError('Object of type %s is not JSON serializable' % type(value).__name__)
+    value = convert(value)
+    if isinstance(value, Number):
+        return number(value)
+    return value
+
+
+def json_default(value):
+    """
+    `default` hook for json.dumps of query results, which are no dicts:
+
+        json.dumps(rows, default=tools.json_default)
+
+    Rows become objects, iterbetters / generators arrays and the registered
+    types their JSON form, but a Decimal a float: only tools.response and
+    `encode` write it exactly.
+    """
+    return _default_of(value, {}, float)
+
+
+def _fragment(number):
+    # written as is, never through a float
+    return orjson.Fragment(str(number))
+
+
+def _tree(value):
+    """`value` with its result sets in the columnar layout, for orjson"""
+    if isinstance(value, Row):
+        # a row of a result set holds plain values, anything else is a document
+        if not any(isinstance(v, (dict, Row) + _arrays) for v in value.values()):
+            return value
+        value = value.todict()
+    if isinstance(value, dict):
+        return dict((k, _tree(v)) for k, v in value.items())
+    if not isinstance(value, _arrays):
+        return value
+    rows = value if isinstance(value, list) else list(value)
+    if not rows:
+        return rows
+    columns = _columns_of(rows[0], value)
+    if columns is None:
+        return [_tree(v) for v in rows]
+    return {'columns': columns, 'rows': list(map(_row_values(rows[0], columns), rows))}
+
+
+def _relisted(value, listed):
+    """`value` with the iterators consumed by orjson replaced by their rows"""
+    if isinstance(value, (IterBetter, types.GeneratorType)):
+        return listed.get(id(value), value)
+    if isinstance(value, dict):
+        return dict((k, _relisted(v, listed)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_relisted(v, listed) for v in value]
+    return value
+
+
+if ORJSON:
+    # datetimes, dataclasses and subclasses of str, dict... go to `default`,
+    # i.e. through their registered converter, rather than orjson's own forms
+    _ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                       | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_SUBCLASS)
+
+
+def envelope(code, desc, datas, columnar=False):
+    """the body of tools.response, as bytes"""
+    # orjson writes a UUID itself, with no option to hand it over: only the
+    # converter registered by default gives the same text
+    if ORJSON and _converter(uuid.UUID) is str:
+        if columnar:
+            # the result sets are laid out here, not again by the fallback
+            datas, columnar = _tree(datas), False
+        listed = {}
+        try:
+            return orjson.dumps({'code': code, 'desc': desc, 'datas': datas},
+                                default=lambda value: _default_of(value, listed, _fragment),
+                                option=_ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            if listed:
+                datas = _relisted(datas, listed)
+    out = ['{"code": ']
+    _encode(code, out)
+    out.append(', "desc": ')
+    _encode(desc, out)
+    out.append(', "datas": ')
+    _encode(datas, out, columnar)
+    out.append('}')
+    return ''.join(out).encode('ascii')
+
+
+def negotiate(accept):
+    """
+    The media type of MEDIA_TYPES to answer with for an Accept header: the one
+    with the highest q, JSON on a tie and when the header names none of them.
+
+        >>> negotiate('')
+        'application/json'
+        >>> negotiate('application/cbor;q=0.5, application/x-msgpack') in (MSGPACK, JSON)
+        True
+        >>> negotiate('text/html, */*;q=0.1')
+        'application/json'
+    """
+    ranges = []
+    for item in accept.split(','):
+        media_range, _, params = item.partition(';')
+        media_range = media_range.strip().lower()
+        media_range = _aliases.get(media_range, media_range)
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_range:
+            ranges.append((media_range, q))
+
+    best, best_q = JSON, 0.0
+    for media_type in MEDIA_TYPES:
+        # the most specific range naming the type gives its q
+        main = media_type.split('/')[0] + '/*'
+        matches = dict((r, q) for r, q in ranges if r in (media_type, main, '*/*'))
+        q = matches.get(media_type, matches.get(main, matches.get('*/*', 0.0)))
+        if q > best_q:
+            best, best_q = media_type, q
+    return best
+
+
+def _cbor_convert(encoder, value):
+    encoder.encode(_converter(type(value))(value))
+
+
+# cbor2 writes these itself, as tags most clients don't read (and refuses naive datetimes)
+_cbor_encoders = dict((cls, _cbor_convert) for cls in (datetime.datetime, datetime.date, uuid.UUID))
+
+
+def pack(media_type, code, desc, datas, columnar=False):
+    """
+    The body of tools.response for `media_type`, as (media type, bytes): JSON
+    as `envelope` writes it, else MessagePack or CBOR. JSON is used instead
+    when MessagePack can't hold a value (ints beyond 64 bits).
+    """
+    media_type = _aliases.get(media_type, media_type)
+    if media_type not in MEDIA_TYPES or media_type == JSON:
+        return JSON, envelope(code, desc, datas, columnar)
+    if columnar:
+        datas, columnar = _tree(datas), False
+    tree = {'code': code, 'desc': desc, 'datas': datas}
+    listed = {}
+    if media_type == CBOR:
+        return CBOR, cbor2.dumps(tree, encoders=_cbor_encoders,
+                                 default=lambda encoder, value: encoder.encode(
+                                     _default_of(value, listed, decimal.Decimal)))
+    try:
+        return MSGPACK, msgpack.packb(tree, use_bin_type=True,
+                                      default=lambda value: _default_of(value, listed, float))
+    except (OverflowError, TypeError):
+        # ints beyond 64 bits get to `default`, JSON writes them (or raises the same)
+        if listed:
+            datas = _relisted(datas, listed)
+        return JSON, envelope(code, desc, datas, columnar)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+cooperative (gevent) serving mode
+
+With ACCURAD_GEVENT=1 wsgi.py monkey patches the stdlib before django or any
+driver is imported, threading.local then becomes greenlet local, so every greenlet gets
+its own db context (connection + transaction stack) in tools.db.
+
+Only drivers talking to the socket from python yield to the gevent hub, the
+C drivers block the whole worker while they wait on the database:
+
+    driver              dbn         cooperative
+    pymysql             mysql       yes
+    mysql.connector     mysql       yes (pure python build, use_pure=True)
+    MySQLdb             mysql       no
+    cx_Oracle           oracle      no
+    ibm_db              db2         no
+    pymssql             mssql       no
+    psycopg2            postgres    no (yes with psycogreen)
+    sqlite3             sqlite      no
+    suds                soap        yes
+"""
+
+import os
+import sys
+
+__all__ = ["COOPERATIVE", "patched", "check_local", "check_driver"]
+
+COOPERATIVE = {
+    "pymysql": True,
+    "mysql.connector": True,
+    "MySQLdb": False,
+    "cx_Oracle": False,
+    "ibm_db": False,
+    "pymssql": False,
+    "psycopg2": False,
+    "pgdb": False,
+    "sqlite3": False,
+    "kinterbasdb": False,
+}
+
+_warned = set()
+
+
+def patched():
+    """True if the process runs on a gevent patched stdlib"""
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is None:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def check_local():
+    """warns when tools was imported before the patch, db contexts would then
+    be shared by all greenlets of a thread"""
+    if not patched() or 'late' in _warned:
+        return True
+    from gevent.local import local
+    from .utils import ThreadLocalDict
+    if issubclass(ThreadLocalDict, local):
+        return True
+    _warned.add('late')
+    print("warning: gevent patched after tools was imported, db contexts are not greenlet local(%s)"
+          % os.getpid(), file=sys.stderr)
+    return False
+
+
+def check_driver(db_module):
+    """warns once per driver that would block the hub under gevent"""
+    if db_module is None or not patched():
+        return True
+    name = db_module.__name__
+    ok = COOPERATIVE.get(name, False)
+    if name == "psycopg2" and 'psycogreen' in sys.modules:
+        ok = True
+    if not ok and name not in _warned:
+        _warned.add(name)
+        print("warning: db driver [%s] is not gevent cooperative, each query blocks the worker(%s)"
+              % (name, os.getpid()), file=sys.stderr)
+    return ok
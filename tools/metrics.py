@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+"""
+process metrics
+
+Components register a provider returning a dict of their counters,
+`snapshot()` collects them all (see api/server-manage/metrics.py).
+"""
+
+import os
+import time
+
+__all__ = ["register", "snapshot"]
+
+_providers = {}
+_started = time.time()
+
+
+def register(name, provider):
+    """registers `provider`, a callable returning a dict, under `name`"""
+    _providers[name] = provider
+
+
+def snapshot():
+    out = {"pid": os.getpid(), "uptime": round(time.time() - _started, 1)}
+    for name, provider in list(_providers.items()):
+        try:
+            out[name] = provider()
+        except Exception as e:
+            out[name] = {"error": str(e)}
+    return out
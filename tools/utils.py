@@ -12,7 +12,7 @@ __all__ = [
   "iters", 
   "rstrips", "lstrips", "strips",
   "timelimit",
-  "Memoize", "memoize",
+  "Memoize", "memoize", "LRU", "Row", "rowtype",
   "re_compile", "re_subm",
   "group", "uniq", "iterview",
   "IterBetter", "iterbetter",
@@ -23,11 +23,12 @@ __all__ = [
   "numify", "denumify", "commify", "dateify",
   "nthstr", "cond",
   "CaptureStdout", "capturestdout", "Profile", "profile",
-  "ThreadedDict", "threadeddict",
+  "ThreadedDict", "threadeddict", "ThreadLocalDict", "threadlocaldict",
   "to36"
 ]
 
-import re, sys, time, threading, itertools, traceback
+import re, sys, time, threading, itertools, traceback, collections
+import collections.abc
 
 import datetime
 from threading import local as threadlocal
@@ -372,6 +373,242 @@ class Memoize:
 
 memoize = Memoize
 
+
+class LRU:
+    """
+    Thread safe cache of at most `maxsize` entries, the least recently used
+    entry is dropped first. `stats()` returns the hit/miss counters.
+
+        >>> c = LRU(2)
+        >>> c.put('a', 1)
+        1
+        >>> c.put('b', 2)
+        2
+        >>> c.get('a')
+        1
+        >>> c.put('c', 3)
+        3
+        >>> c.get('b') is None
+        True
+        >>> c.stats()
+        <Storage {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 1}>
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self._data[key]
+
+    def put(self, key, value):
+        """stores `value` under `key` and returns it"""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return storage(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses)
+
+
+class Row(object):
+    """
+    One row of a result set: its values, in a tuple shared with nothing, and
+    the column names, on the class `rowtype` made for the result set. Reads
+    and writes like a Storage, with the dict methods (`keys()`, `items()`,
+    `get()`, `copy()`, `update()`, `pop()`...), but it is no dict subclass:
+    `isinstance(row, dict)` is False, `dict(row)` / `row._asdict()` make
+    one, and json.dumps needs `default=tools.json_default`.
+
+        >>> Row = rowtype(['a', 'b'])
+        >>> r = Row((1, 'x'))
+        >>> r.a, r['b']
+        (1, 'x')
+        >>> r.a = 2
+        >>> r.c = 3
+        >>> r
+        <Row {'a': 2, 'b': 'x', 'c': 3}>
+        >>> dict(r) == {'a': 2, 'b': 'x', 'c': 3}
+        True
+        >>> r.d
+        Traceback (most recent call last):
+            ...
+        AttributeError: 'd'
+        >>> r.pop('a'), r
+        (2, <Row {'b': 'x', 'c': 3}>)
+    """
+    __slots__ = ["_values", "_extra"]
+    _index = {}  # column name -> position, set by rowtype
+
+    def __init__(self, values):
+        self._values = values
+        self._extra = None  # keys set on the row that are no column
+
+    def __getitem__(self, key):
+        i = self._index.get(key)
+        if i is not None:
+            return self._values[i]
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        i = self._index.get(key)
+        if i is not None:
+            values = list(self._values)
+            values[i] = value
+            self._values = tuple(values)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        index = self._index
+        if key in index:
+            # the row moves to the row class of the remaining columns
+            names = [name for name in index if name != key]
+            values = self._values
+            self._values = tuple(values[index[name]] for name in names)
+            object.__setattr__(self, '__class__', rowtype(names))
+            return
+        if self._extra is None:
+            raise KeyError(key)
+        del self._extra[key]
+
+    def __getattr__(self, key):
+        if key.startswith('__') or key in Row.__slots__:
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError as k:
+            raise AttributeError(k)
+
+    def __setattr__(self, key, value):
+        if key in Row.__slots__:
+            object.__setattr__(self, key, value)
+        else:
+            self[key] = value
+
+    def __delattr__(self, key):
+        try:
+            del self[key]
+        except KeyError as k:
+            raise AttributeError(k)
+
+    def keys(self):
+        keys = list(self._index)
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def values(self):
+        values = self._values
+        out = [values[i] for i in self._index.values()]
+        if self._extra:
+            out.extend(self._extra.values())
+        return out
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def todict(self):
+        return dict(self.items())
+
+    _asdict = todict
+
+    def copy(self):
+        row = type(self)(self._values)
+        if self._extra:
+            row._extra = dict(self._extra)
+        return row
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self[key]
+        return value
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._index) + len(self._extra or ())
+
+    def __contains__(self, key):
+        return key in self._index or bool(self._extra) and key in self._extra
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            other = other.todict()
+        return self.todict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # row classes are made at runtime, a pickled row comes back as a Storage
+        return (Storage, (self.todict(),))
+
+    def __repr__(self):
+        return '<Row %r>' % self.todict()
+
+
+collections.abc.MutableMapping.register(Row)
+
+_rowtypes = LRU(256)
+
+
+def rowtype(names):
+    """Returns the Row class of a result set with columns `names`; a column
+    named twice keeps the last value, as in dict(zip(names, row))."""
+    names = tuple(names)
+    cls = _rowtypes.get(names)
+    if cls is None:
+        index = {}
+        for i, name in enumerate(names):
+            index[name] = i
+        cls = _rowtypes.put(names, type('Row', (Row,), {'__slots__': (), '_index': index}))
+    return cls
+
 re_compile = memoize(re.compile) #@@ threadsafe?
 re_compile.__doc__ = """
 A memoized version of re.compile.
@@ -558,8 +795,11 @@ class IterBetter:
         if hasattr(self, "_head"):
             yield self._head
 
-        while 1:    
-            yield next(self.i)
+        while 1:
+            try:
+                yield next(self.i)
+            except StopIteration:
+                return
             self.c += 1
 
     def __getitem__(self, i):
@@ -1119,6 +1359,23 @@ class ThreadedDict:
 threadeddict = ThreadedDict
 
 
+class ThreadLocalDict(threadlocal, ThreadedDict):
+    """
+    A ThreadedDict whose values are local to each thread, to each greenlet
+    when gevent patched threading before this module was imported.
+    tools.db keeps the connection and transactions of each thread in one.
+
+    `clear_all` clears the values of the calling thread only.
+    """
+    def __repr__(self):
+        return '<ThreadLocalDict %r>' % self.__dict__
+
+    __str__ = __repr__
+
+
+threadlocaldict = ThreadLocalDict
+
+
 def to36(q):
     """
     Converts an integer to base 36 (a useful scheme for human-sayable IDs).